@@ -1,21 +1,22 @@
+import asyncio
+import hashlib
 import logging
 import socket
 import time
-from threading import Thread
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Set
 
+from bitstring import BitArray
 from rich import progress
 
 from PyBitTorrent import Utils
-from PyBitTorrent.Block import BlockStatus
+from PyBitTorrent.Block import Block, BlockStatus
 from PyBitTorrent.Exceptions import (
     PieceIsPending,
-    NoPeersHavePiece,
     NoPieceFound,
     PeerDisconnected,
-    PieceIsFull,
     OutOfPeers,
-    AllPeersChocked,
+    DiskWriteFailed,
 )
 from PyBitTorrent.Message import (
     Handshake,
@@ -26,17 +27,30 @@ from PyBitTorrent.Message import (
     PieceMessage,
     HaveMessage,
     Choke,
+    Interested,
+    NotInterested,
+    Cancel,
+    Port,
 )
+from PyBitTorrent.Peer import Peer
 from PyBitTorrent.PeersManager import PeersManager
-from PyBitTorrent.Piece import Piece, create_pieces
+from PyBitTorrent.Piece import Piece
+from PyBitTorrent.PiecePicker import PiecePicker
+from PyBitTorrent.PieceStore import PieceStore
 from PyBitTorrent.PiecesManager import DiskManager
+from PyBitTorrent.ResumeData import ResumeData
 from PyBitTorrent.TorrentFile import TorrentFile
 from PyBitTorrent.TrackerFactory import TrackerFactory
 from PyBitTorrent.TrackerManager import TrackerManager
+from PyBitTorrent.Uploader import Uploader
 from PyBitTorrent.Utils import generate_peer_id, read_peers_from_input
+from PyBitTorrent.WriteCache import WriteCache
 from PyBitTorrent.Exceptions import NoTrackersFound
 from PyBitTorrent.Configuration import CONFIGURATION
 
+# Seconds between the checks if more peers are needed from the trackers
+PEERS_CHECK_INTERVAL = 5
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S'
@@ -49,17 +63,27 @@ class TorrentClient:
             max_peers: int = CONFIGURATION.max_peers,
             use_progress_bar: bool = True,
             peers_input: str = None,
-            output_dir: str = '.'
+            output_dir: str = '.',
+            sequential_download: bool = False,
+            seed: bool = False
     ):
         self.peer_manager: PeersManager = PeersManager(max_peers)
         self.tracker_manager: TrackerManager
         self.id: bytes = generate_peer_id()
         self.listener_socket: socket.socket = socket.socket()
-        self.listener_socket.settimeout(CONFIGURATION.timeout)
         self.port: int = CONFIGURATION.listening_port
         self.peers_input: str = peers_input
-        self.pieces: List[Piece] = []
         self.should_continue = True
+        self.seed = seed  # Keep uploading after the download completed
+        self.endgame = False
+        self.duplicate_bytes = 0  # Bytes received for blocks we already had
+        self.downloaded = 0  # Bytes of all the blocks received, reported to the trackers
+        # Set whenever something happened that may allow new requests
+        self.requests_event: asyncio.Event = None
+        # Set whenever a piece was verified and written
+        self.progress_event: asyncio.Event = None
+        self.hash_pool = ThreadPoolExecutor(CONFIGURATION.hash_workers)
+        self._verifications: Set[asyncio.Future] = set()
         self.use_progress_bar = use_progress_bar
         if use_progress_bar:
             logging.getLogger("BitTorrent").setLevel(CONFIGURATION.logging_level)
@@ -67,159 +91,511 @@ class TorrentClient:
         # decode the config file and assign it
         self.torrent = TorrentFile(torrent)
         self.piece_manager = DiskManager(output_dir, self.torrent)
-        # create tracker for each url of tracker in the config file
-        trackers = []
-        if "announce" in self.torrent.config:
-            tracker = TrackerFactory.create_tracker(self.torrent.config["announce"])
-            trackers.append(tracker)
-
+        self.write_cache = WriteCache(self.piece_manager, self.torrent.piece_size)
+        self.write_cache.on_flushed = self.handle_pieces_written
+        self.write_cache.on_failed = self.handle_write_failed
+        self.resume_data = ResumeData(output_dir, self.torrent, self.piece_manager)
+        # create the tiers of trackers, when there is an announce-list the announce is ignored (BEP 12)
         if "announce-list" in self.torrent.config:
-            new_trackers = TrackerFactory.create_trackers(
-                self.torrent.config["announce-list"]
-            )
-            trackers += new_trackers
-
-        while None in trackers:
-            trackers.remove(None)
+            tiers = TrackerFactory.create_tiers(self.torrent.config["announce-list"])
+        elif "announce" in self.torrent.config:
+            tiers = TrackerFactory.create_tiers([[self.torrent.config["announce"]]])
+        else:
+            tiers = []
 
-        if len(trackers) == 0:
+        if len(tiers) == 0:
             raise NoTrackersFound
 
-        self.tracker_manager = TrackerManager(trackers)
+        self.tracker_manager = TrackerManager(tiers)
         file_size, piece_size = self.torrent.length, self.torrent.piece_size
-        self.pieces = create_pieces(file_size, piece_size)
-        self.number_of_pieces = len(self.pieces)
+        self.piece_store = PieceStore(file_size, piece_size)
+        self.number_of_pieces = self.piece_store.number_of_pieces
+        self.piece_picker = PiecePicker(self.number_of_pieces, sequential_download)
+        self.uploader = Uploader(
+            self.peer_manager, self.piece_store, self.write_cache, self.piece_manager, piece_size
+        )
+        self.peer_manager.on_peer_removed = self.handle_peer_removed
+        self.peer_manager.on_peer_connected = self.handle_peer_connected
+        self.peer_manager.block_buffer = self.piece_store.pin_block
+        self.peer_manager.on_block_sent = self.uploader.block_sent
 
     def setup(self):
-        # Send HTTP/UDP Requests to all Trackers, requesting for peers
-        if self.peers_input:
-            logging.getLogger("BitTorrent").info("Reading peers from input")
-            peers = read_peers_from_input(self.peers_input)
-        else:
-            peers = self.tracker_manager.get_peers(self.id, self.port, self.torrent)
-            if len(peers) == 0:
-                raise Exception("No peers found")
-
+        """
+        Add the peers given by the user, instead of announcing to the trackers
+        """
+        logging.getLogger("BitTorrent").info("Reading peers from input")
+        peers = read_peers_from_input(self.peers_input)
         logging.getLogger("BitTorrent").info(f"Number of peers: {len(peers)}")
-
         self.peer_manager.add_peers(peers)
 
+    async def announce(self, tiers: List[int] = None, event: str = "", **kwargs) -> int:
+        """
+        Send HTTP/UDP Requests to the Trackers with our statistics, requesting for
+        peers. The peers of every tracker are connected as soon as it answers.
+        """
+        # No new peers are wanted once done, unless seeding
+        done = event == "stopped" or (event == "completed" and not self.seed)
+        on_peers = self.peer_manager.add_peers if not done else lambda peers: None
+        number_of_peers = await self.tracker_manager.announce(
+            self.id, self.port, self.torrent, on_peers, tiers=tiers, event=event,
+            uploaded=self.uploader.uploaded, downloaded=self.downloaded, left=self.piece_store.left,
+            **kwargs
+        )
+        if event != "stopped":
+            logging.getLogger("BitTorrent").info(f"Number of peers: {number_of_peers}")
+
+        return number_of_peers
+
+    async def announce_periodically(self):
+        """
+        Announce to every tier whenever its tracker asks to, and earlier when
+        peers are missing and no more are known, once its min interval passed
+        """
+        self.peer_manager.searching = True
+        try:
+            # The best trackers of every tier are announced to first
+            await self.tracker_manager.rank(self.torrent)
+            while True:
+                tiers = self.tracker_manager.due_tiers(self.peer_manager.needs_peers())
+                if tiers:
+                    await self.announce(tiers)
+
+                delay = self.tracker_manager.time_to_next_announce(self.peer_manager.needs_peers())
+                # Check again soon, peers may disconnect meanwhile
+                await asyncio.sleep(min(max(delay, 0), PEERS_CHECK_INTERVAL))
+        finally:
+            self.peer_manager.searching = False
+
+    def listen(self) -> bool:
+        """
+        Bind the listener socket to the first free port of the
+        listening ports range, so other peers can connect to us
+        """
+        for port in range(CONFIGURATION.listening_port, CONFIGURATION.max_listening_port + 1):
+            try:
+                self.listener_socket.bind(("", port))
+            except OSError:
+                continue
+
+            self.port = port
+            self.listener_socket.listen()
+            self.listener_socket.setblocking(False)
+            logging.getLogger("BitTorrent").info(f"Listening for peers on port {port}")
+            return True
+
+        logging.getLogger("BitTorrent").error("No free listening port, peers will not be able to connect to us")
+        return False
+
     def start(self):
-        if len(self.peer_manager.peers) == 0:
+        try:
+            asyncio.run(self.download())
+        except KeyboardInterrupt:
+            # The way to stop seeding, the progress was already saved
+            logging.getLogger("BitTorrent").info("Stopped by the user")
+        except OutOfPeers:
+            # The progress was saved, the download can be resumed with other peers
+            logging.getLogger("BitTorrent").error("No peers left to download from")
+        except DiskWriteFailed as e:
+            # The pieces written before the failure were saved, the others are downloaded again
+            logging.getLogger("BitTorrent").error(f"Stopped, the downloaded data can't be written: {e}")
+
+        Utils.console.print("[green]GoodBye!")
+
+    async def download(self):
+        """
+        Drive the whole download from a single event loop:
+        the handshakes, the requester and the messages handling
+        are all coroutines running side by side.
+        """
+        listening = self.listen()  # Before announcing our port to the trackers
+        self.requests_event = asyncio.Event()
+        self.progress_event = asyncio.Event()
+        await self.resume()
+        handshakes = asyncio.ensure_future(
+            self.peer_manager.send_handshakes(self.id, self.torrent.hash)
+        )
+        if self.peers_input:
             self.setup()
+        announcer = None
+        if len(self.peer_manager.peers) == 0:
+            announcer = asyncio.ensure_future(self.announce_periodically())
+        requester = asyncio.ensure_future(self.piece_requester())
+        handler = asyncio.ensure_future(self.handle_messages())
+        choker = asyncio.ensure_future(self.uploader.run())
+        listener = None
+        if listening:
+            listener = asyncio.ensure_future(
+                self.peer_manager.accept_peers(self.listener_socket, self.id, self.torrent.hash)
+            )
 
-        handshakes = Thread(
-            target=self.peer_manager.send_handshakes, args=(self.id, self.torrent.hash)
+        try:
+            await self.progress_download(handler)
+            await requester
+            # The trackers count the completed downloads, seeding or not
+            if announcer:
+                await self.announce(event="completed")
+            if self.seed:
+                logging.getLogger("BitTorrent").info("Download completed, seeding")
+                await handler
+        finally:
+            if announcer:
+                announcer.cancel()
+                await self.announce(event="stopped", deadline=CONFIGURATION.timeout)
+            self.tracker_manager.close()
+            tasks = [handshakes, requester, handler, choker, *self._verifications]
+            if listener:
+                tasks.append(listener)
+            for task in tasks:
+                task.cancel()
+
+            # Wait for the tasks to stop, so an error they stopped with, like OutOfPeers, is not left unhandled
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.listener_socket.close()
+            self.uploader.close()
+            try:
+                await self.write_cache.close()
+            finally:
+                # Even when the cache couldn't be written, what was written is saved
+                try:
+                    self.save_resume_data()
+                except OSError as e:
+                    logging.getLogger("BitTorrent").error(f"Failed to save the resume data: {e}")
+                finally:
+                    self.piece_manager.close()
+                    self.hash_pool.shutdown()
+                    self.peer_manager.close()
+
+    async def resume(self):
+        """
+        Skip the work done by a previous run. The resume data is trusted
+        when the files were not changed since it was saved, otherwise
+        the data found in the files is checked against the pieces hashes.
+        """
+        resume = self.resume_data.load()
+        if resume is None:
+            await self.recheck_pieces()
+            return
+
+        pieces = resume["pieces"]
+        index = pieces.find(1)
+        while index != -1:
+            self._piece_found(index)
+            index = pieces.find(1, index + 1)
+
+        for index, blocks in resume["partial"].items():
+            self._load_partial_piece(index, blocks)
+
+        logging.getLogger("BitTorrent").info(
+            f"Resuming with {self.piece_store.completed_pieces}/{self.number_of_pieces} pieces"
         )
-        requester = Thread(target=self.piece_requester)
 
-        handshakes.start()
-        requester.start()
-        self.progress_download()
-        handshakes.join()
-        requester.join()
-        Utils.console.print("[green]GoodBye!")
+    async def recheck_pieces(self):
+        """
+        Check the pieces stored in the files on the hashing threads,
+        keeping a few pieces in flight for every thread
+        """
+        if not any(file.existing_size for file in self.piece_manager.files):
+            return  # New files, nothing to check
+
+        loop = asyncio.get_running_loop()
+        checks = set()
+        for index in range(self.number_of_pieces):
+            size = self.piece_store.get_piece_size(index)
+            if not self.piece_manager.has_existing_data(index * self.torrent.piece_size, size):
+                continue
 
-    def progress_download(self):
-        if self.use_progress_bar:
-            for _ in progress.track(
-                    range(len(self.pieces)),
-                    description=f"Downloading {self.torrent.file_name}",
-            ):
-                self.handle_messages()
-        else:
-            for _ in range(len(self.pieces)):
-                self.handle_messages()
+            if len(checks) >= 2 * CONFIGURATION.hash_workers:
+                done, checks = await asyncio.wait(checks, return_when=asyncio.FIRST_COMPLETED)
+                self._recheck_done(done)
 
-    def handle_messages(self):
-        while not self._all_pieces_full():
-            try:
-                # Utils.console.print.f'[purple]Waiting for message...')
-                messages = self.peer_manager.receive_messages()
-            except OutOfPeers:
-                logging.getLogger("BitTorrent").error(
-                    f"No peers found, sleep for 2 seconds"
-                )
-                time.sleep(2)
+            checks.add(loop.run_in_executor(self.hash_pool, self._check_stored_piece, index))
+
+        if checks:
+            done, _ = await asyncio.wait(checks)
+            self._recheck_done(done)
+
+        logging.getLogger("BitTorrent").info(
+            f"Recheck found {self.piece_store.completed_pieces}/{self.number_of_pieces} pieces"
+        )
+
+    def _check_stored_piece(self, index):
+        """
+        Runs in the hash pool
+        """
+        size = self.piece_store.get_piece_size(index)
+        data = self.piece_manager.read(index * self.torrent.piece_size, size)
+        return index, self._check_hash(index, data)
+
+    def _recheck_done(self, checks):
+        for check in checks:
+            index, valid = check.result()
+            if valid:
+                self._piece_found(index)
+                self.resume_data.pieces_written([index])
+
+    def _piece_found(self, index):
+        self.piece_store.set_completed(index)
+        self.piece_picker.piece_completed(index)
+
+    def _load_partial_piece(self, index, blocks: bytes):
+        """
+        Read back the blocks of an uncompleted piece that
+        were written to the disk when the last run stopped
+        """
+        try:
+            piece = self.piece_store.get_piece(index)
+        except NoPieceFound:
+            return
+
+        data = memoryview(self.piece_manager.read(index * self.torrent.piece_size, piece.size))
+        for position, full in enumerate(blocks[:piece.number_of_blocks]):
+            if full:
+                block = Block(piece, position)
+                self.piece_store.set_full(piece, block, data[block.offset:block.offset + block.size])
+
+        self.piece_picker.piece_started(index)
+        if piece.is_full():
+            self._schedule_verification(piece)
+
+    def handle_pieces_written(self, indices):
+        self.resume_data.pieces_written(indices)
+        self.resume_data.save()
+
+    def handle_write_failed(self, error):
+        self.progress_event.set()  # progress_download stops the download
+
+    def save_resume_data(self):
+        """
+        Write the received blocks of the uncompleted pieces in
+        place, so the next run can continue from them
+        """
+        partial = {}
+        for piece in self.piece_store:
+            blocks = bytes(status == BlockStatus.FULL for status in piece.block_status)
+            if not any(blocks):
                 continue
-            except socket.error as e:
-                logging.getLogger("BitTorrent").info(f"Unknown socket error: {e}")
+
+            for block in piece.blocks:
+                if blocks[block.position]:
+                    offset = piece.index * self.torrent.piece_size + block.offset
+                    self.piece_manager.write(offset, [piece.get_block_buffer(block)])
+
+            partial[piece.index] = blocks
+
+        self.resume_data.save(partial)
+
+    async def progress_download(self, handler: asyncio.Future):
+        """
+        Show the progress until all the pieces are verified and written,
+        or until the messages handling or the disk writes stopped because of an error
+        """
+        with progress.Progress(disable=not self.use_progress_bar) as progress_bar:
+            task = progress_bar.add_task(
+                f"Downloading {self.torrent.file_name}", total=self.number_of_pieces
+            )
+            while not self.piece_store.is_complete():
+                progress_event = asyncio.ensure_future(self.progress_event.wait())
+                await asyncio.wait([progress_event, handler], return_when=asyncio.FIRST_COMPLETED)
+                progress_event.cancel()
+                if handler.done():
+                    handler.result()
+                if self.write_cache.error is not None:
+                    raise self.write_cache.error
+
+                self.progress_event.clear()
+                progress_bar.update(task, completed=self.piece_store.completed_pieces)
+
+    async def handle_messages(self):
+        """
+        Handle the messages of all the peers, batch after batch,
+        until all the pieces are downloaded, or forever when seeding
+        """
+        while self.seed or not self.piece_store.is_complete():
+            # Utils.console.print.f'[purple]Waiting for message...')
+            # Raises OutOfPeers when no peer is left and none can come
+            messages = await self.peer_manager.receive_messages()
+            await self.handle_messages_batch(messages)
+
+    async def handle_messages_batch(self, messages):
+        """
+        Handle the messages received from the peers
+        """
+        for peer, message in messages:
+            # The peer was removed after its messages were queued, its
+            # bitfield was already taken out of the piece availability
+            if not peer.connected:
                 continue
 
-            for peer, message in messages.items():
-                if type(message) is Handshake:
-                    peer.verify_handshake(message)
+            if type(message) is Handshake:
+                peer.verify_handshake(message)
 
-                elif type(message) is BitField:
-                    logging.getLogger("BitTorrent").info(f"Got bitfield from {peer}")
-                    peer.set_bitfield(message)
+            elif type(message) is BitField:
+                logging.getLogger("BitTorrent").info(f"Got bitfield from {peer}")
+                self.piece_picker.remove_bitfield(peer.bitfield)
+                peer.set_bitfield(message)
+                self.piece_picker.add_bitfield(peer.bitfield)
+                await self.send_interested(peer)
 
-                elif type(message) is HaveMessage:
+            elif type(message) is HaveMessage:
+                if not peer.have_piece(message.index):
                     peer.set_have(message)
+                    if peer.have_piece(message.index):
+                        self.piece_picker.add_have(message.index)
 
-                elif type(message) is KeepAlive:
-                    logging.getLogger("BitTorrent").debug(f"Got keep alive from {peer}")
+                await self.send_interested(peer)
 
-                elif type(message) is Choke:
-                    peer.set_choked()
+            elif type(message) is KeepAlive:
+                logging.getLogger("BitTorrent").debug(f"Got keep alive from {peer}")
 
-                elif type(message) is Unchoke:
-                    logging.getLogger("BitTorrent").debug(f"Received unchoke from {peer}")
-                    peer.set_unchoked()
+            elif type(message) is Choke:
+                self._free_pending_blocks(peer)
+                peer.set_choked()
 
-                elif type(message) is PieceMessage:
-                    # "Got piece!", message)
-                    if self.handle_piece(message):
-                        return
+            elif type(message) is Unchoke:
+                logging.getLogger("BitTorrent").debug(f"Received unchoke from {peer}")
+                peer.set_unchoked()
 
-                else:
-                    logging.getLogger("BitTorrent").error(
-                        f"Unknown message: {message.id}"
-                    )  # should be error
+            elif type(message) is PieceMessage:
+                # "Got piece!", message)
+                await self.handle_piece(peer, message)
 
-    def piece_requester(self):
+            elif type(message) is Interested:
+                await self.uploader.peer_interested(peer)
+
+            elif type(message) is NotInterested:
+                await self.uploader.peer_not_interested(peer)
+
+            elif type(message) is Request:
+                self.uploader.add_request(peer, message)
+
+            elif type(message) is Cancel:
+                self.uploader.cancel_request(peer, message)
+
+            elif type(message) is Port:
+                logging.getLogger("BitTorrent").debug(f"{peer} has a DHT node on port {message.port}")
+
+            else:
+                logging.getLogger("BitTorrent").error(
+                    f"Unknown message: {message.id}"
+                )  # should be error
+
+        if messages:
+            self.requests_event.set()
+
+    def handle_peer_removed(self, peer: Peer):
         """
-        This function will run as different thread.
-        Iterate over all the blocks of all the pieces
-        in chronological order, and see if one of them is free.
-        is yes - request it from random peer.
+        The pieces of a disconnected peer are not available
+        anymore, and the blocks it was asked for will never come
         """
+        self.piece_picker.remove_bitfield(peer.bitfield)
+        self.piece_store.unpin_blocks(peer)
+        self._free_pending_blocks(peer)
+        peer.pending_requests.clear()
+        self.uploader.peer_removed(peer)
 
-        while self.should_continue:
-            self.request_current_block()
-            time.sleep(CONFIGURATION.iteration_sleep_interval)
+    async def handle_peer_connected(self, peer: Peer):
+        """
+        Tell a new peer which pieces we have, this
+        must be the first message after the handshake
+        """
+        if not self.piece_store.completed_pieces:
+            return
 
-        logging.getLogger("BitTorrent").info(f"Exiting the requesting loop...")
-        self.piece_manager.close()
+        # One byte per piece, 0 or 1, into a string of bits
+        bits = bytes(self.piece_store.completed).translate(bytes.maketrans(b"\x00\x01", b"01"))
+        try:
+            await peer.send_message(BitField(BitArray(bin=bits.decode())))
+        except PeerDisconnected:
+            self.peer_manager.remove_peer(peer)
+
+    async def send_have(self, index):
+        """
+        Announce a new piece to the peers that don't have it
+        """
+        have = HaveMessage(index)
+        for peer in list(self.peer_manager.connected_peers):
+            if peer.have_piece(index):
+                continue
 
-    def request_current_block(self):
-        for piece in self.pieces:
             try:
-                block = piece.get_free_block()
-                peer = self.peer_manager.get_random_peer_by_piece(piece)
-                request = Request(piece.index, block.offset, block.size)
-                peer.send_message(request)
-                block.set_requested()
-                return
+                await peer.send_message(have)
+            except PeerDisconnected:
+                self.peer_manager.remove_peer(peer)
 
-            except PieceIsPending:
-                continue
+    async def send_interested(self, peer: Peer):
+        if peer.am_interested:
+            return
 
-            except PieceIsFull:
-                continue
+        try:
+            await peer.send_message(Interested())
+            peer.am_interested = True
+        except PeerDisconnected:
+            self.peer_manager.remove_peer(peer)
 
-            except NoPeersHavePiece:
-                logging.getLogger("BitTorrent").debug(
-                    f"No peers have piece {piece.index}"
-                )
-                time.sleep(2.5)
+    async def piece_requester(self):
+        """
+        This coroutine runs alongside the messages handling.
+        Keep the requests queue of every unchoked peer full, then
+        wait until a message arrives or the request interval passes.
+        """
 
-            except AllPeersChocked:
-                logging.getLogger("BitTorrent").debug(
-                    f"All of "
-                    f"{len(self.peer_manager.connected_peers)} peers is chocked"
+        while self.should_continue:
+            self.requests_event.clear()
+            self.write_cache.flush_if_needed()
+            await self.request_blocks()
+            try:
+                await asyncio.wait_for(
+                    self.requests_event.wait(), CONFIGURATION.request_interval
                 )
-                time.sleep(2.5)
+            except asyncio.TimeoutError:
+                pass
+
+        logging.getLogger("BitTorrent").info(f"Exiting the requesting loop...")
+        if self.endgame:
+            logging.getLogger("BitTorrent").info(
+                f"Endgame mode received {self.duplicate_bytes} duplicate bytes"
+            )
+
+    async def request_blocks(self):
+        """
+        Pipeline requests: send each unchoked peer free blocks of
+        pieces it has, until it has request_queue_depth of them
+        outstanding. The queue depth grows with the peer's rate, so
+        the blocks are routed to the peers by their capacity, and the
+        fastest peers go first to get the pieces the picker prefers.
+        Once every block left was requested, switch to endgame mode.
+        While the write cache is full, no new blocks are requested.
+        """
+        if not self.endgame and self.piece_store.free_blocks == 0:
+            logging.getLogger("BitTorrent").info("Entering endgame mode")
+            self.endgame = True
+
+        peers = self.peer_manager.peers_by_capacity()
+        fastest_rate = peers[0].download_rate if peers else 0
+        for peer in peers:
+            if self.write_cache.is_full():
+                break
+
+            expired = peer.expire_requests()
+            if expired:
+                await self.reassign_requests(peer, expired)
+
+            # Picking the pieces costs even when no request is sent
+            if len(peer.pending_requests) >= peer.request_queue_depth:
+                continue
+
+            slow = peer.download_rate < fastest_rate * CONFIGURATION.slow_peer_ratio
+            try:
+                blocks = self._endgame_blocks(peer) if self.endgame else self._free_blocks(peer, slow)
+                for piece, block in blocks:
+                    if len(peer.pending_requests) >= peer.request_queue_depth:
+                        break
+
+                    request = Request(piece.index, block.offset, block.size)
+                    await peer.send_message(request)
+                    self.piece_store.set_requested(piece, block, peer)
+                    peer.add_request(piece.index, block.offset)
+                    self.piece_picker.piece_started(piece.index)
 
             except PeerDisconnected:
                 logging.getLogger("BitTorrent").error(
@@ -227,49 +603,133 @@ class TorrentClient:
                 )
                 self.peer_manager.remove_peer(peer)
 
-        if self._all_pieces_full():
+        if self.piece_store.is_complete():
             self.should_continue = False
 
-    def _all_pieces_full(self) -> bool:
-        for piece in self.pieces:
-            if not piece.is_full():
-                return False
+    def _free_blocks(self, peer: Peer, slow: bool = False):
+        """
+        Yield the free blocks of the pieces the given peer have,
+        in the order the piece picker chose. A slow peer only gets
+        pieces no other peer works on, so the other peers never
+        wait for its blocks to complete their pieces.
+        Stops once the peer's queue is full, before the next piece,
+        whose data is allocated the first time it is needed.
+        """
+        for index in self.piece_picker.pick(peer.have_piece):
+            if len(peer.pending_requests) >= peer.request_queue_depth:
+                return
+
+            try:
+                piece = self.piece_store.get_piece(index)
+            except NoPieceFound:
+                continue
 
-        return True
+            if slow and any(owner is not None and owner is not peer for owner in piece.owners):
+                continue
 
-    def _get_piece_by_index(self, index):
-        for piece in self.pieces:
-            if piece.index == index:
-                return piece
+            for block in piece.get_free_blocks():
+                yield piece, block
 
-        raise NoPieceFound
+    def _endgame_blocks(self, peer: Peer):
+        """
+        In endgame mode all the missing pieces are in flight. Yield every
+        block that did not arrive yet and was not requested from the given
+        peer, even if it was already requested from another peer. The first
+        copy to arrive wins and the other requests get cancelled.
+        """
+        for piece in self.piece_store:
+            if not peer.have_piece(piece.index):
+                continue
+
+            for block in piece.blocks:
+                if block.status != BlockStatus.FULL and (piece.index, block.offset) not in peer.pending_requests:
+                    yield piece, block
+
+    async def cancel_requests(self, index, offset, length):
+        """
+        Cancel the request for the given block
+        from all the peers still waiting to send it
+        """
+        cancel = Cancel(index, offset, length)
+        for peer in list(self.peer_manager.connected_peers):
+            if (index, offset) not in peer.pending_requests:
+                continue
+
+            del peer.pending_requests[(index, offset)]
+            try:
+                await peer.send_message(cancel)
+            except PeerDisconnected:
+                self.peer_manager.remove_peer(peer)
 
-    def handle_piece(self, pieceMessage: PieceMessage):
+    async def reassign_requests(self, peer: Peer, requests):
+        """
+        Free the blocks the peer didn't send in time so any peer can get them,
+        and cancel them so the peer doesn't waste bandwidth on them
+        """
+        logging.getLogger("BitTorrent").debug(
+            f"{len(requests)} requests to {peer} timed out after {peer.request_timeout:.2f} seconds"
+        )
+        for index, offset in requests:
+            try:
+                piece, block = self.piece_store.get_block(index, offset)
+            except (NoPieceFound, PieceIsPending):
+                continue
+
+            if block.status != BlockStatus.REQUESTED or piece.owners[block.position] is not peer:
+                continue  # Requested again from another peer meanwhile
+
+            self.piece_store.set_free(piece, block)
+            try:
+                await peer.send_message(Cancel(index, offset, block.size))
+            except PeerDisconnected:
+                self.peer_manager.remove_peer(peer)
+                return
+
+    def _free_pending_blocks(self, peer: Peer):
+        """
+        Free the blocks the peer won't send anymore so other peers can get them
+        """
+        for index, offset in peer.pending_requests:
+            try:
+                piece, block = self.piece_store.get_block(index, offset)
+            except (NoPieceFound, PieceIsPending):
+                continue
+
+            self.piece_store.set_free(piece, block)
+
+    async def handle_piece(self, peer: Peer, pieceMessage: PieceMessage):
+        peer.block_received(pieceMessage.index, pieceMessage.offset, len(pieceMessage.data))
+        self.downloaded += len(pieceMessage.data)
         try:
             if not len(pieceMessage.data):
-                logging.getLogger("BitTorrent").debug("Empty piece:", pieceMessage.index)
+                logging.getLogger("BitTorrent").debug(f"Empty piece: {pieceMessage.index}")
                 return
 
-            piece = self._get_piece_by_index(pieceMessage.index)
-            block = piece.get_block_by_offset(pieceMessage.offset)
-            block.data = pieceMessage.data
-            block.status = BlockStatus.FULL
+            piece, block = self.piece_store.get_block(pieceMessage.index, pieceMessage.offset)
+            if len(pieceMessage.data) != block.size:
+                logging.getLogger("BitTorrent").debug(f"Invalid block size from {peer}")
+                return
 
-            if piece.is_full():
-                self.piece_manager.write_piece(piece, self.torrent.piece_size)
-                self.pieces.remove(piece)
-                if not self.use_progress_bar:
-                    logging.getLogger("BitTorrent").info(
-                        "Progress: {have}/{total} Unchoked peers: {peers_have}/{total_peers}".format(
-                            have=self.piece_manager.written,
-                            total=self.number_of_pieces,
-                            peers_have=self.peer_manager.num_of_unchoked,
-                            total_peers=len(self.peer_manager.connected_peers),
-                        )
-                    )
+            pinned_by, pinned_at = self.piece_store.pinned_by(piece, block)
+            if pinned_by is peer:
+                self.piece_store.unpin_block(piece, block)
+            elif pinned_by is not None and time.time() - pinned_at > pinned_by.request_timeout:
+                # The other peer stopped in the middle of the block, it is
+                # removed so it can't write into the piece anymore
+                logging.getLogger("BitTorrent").info(f"Peer {pinned_by} stalled in the middle of a block")
+                self.peer_manager.remove_peer(pinned_by)
+
+            if self.piece_store.pinned_by(piece, block)[0] is not None or block.status == BlockStatus.FULL:
+                # Another peer is receiving the block into the piece, or it already arrived
+                self.duplicate_bytes += len(pieceMessage.data)
+                return
 
-                del piece
-                return True
+            self.piece_store.set_full(piece, block, pieceMessage.data, peer)
+            if self.endgame:
+                await self.cancel_requests(piece.index, block.offset, block.size)
+
+            if piece.is_full():
+                self._schedule_verification(piece)
 
         except PieceIsPending:
             logging.getLogger("BitTorrent").debug(
@@ -277,6 +737,71 @@ class TorrentClient:
             )
 
         except NoPieceFound:
-            pass
+            # The piece was already completed
+            self.duplicate_bytes += len(pieceMessage.data)
 
-        return False
+    def _schedule_verification(self, piece: Piece):
+        verification = asyncio.ensure_future(self.verify_piece(piece))
+        self._verifications.add(verification)
+        verification.add_done_callback(self._verifications.discard)
+
+    def _check_hash(self, index, data) -> bool:
+        """
+        Runs in the hash pool, hashlib releases the GIL while hashing
+        """
+        return hashlib.sha1(data).digest() == self.torrent.get_piece_hash(index)
+
+    async def verify_piece(self, piece: Piece):
+        """
+        Check the piece against its hash in the torrent file
+        without blocking the event loop. Valid pieces go to the
+        write cache, corrupted pieces are downloaded again.
+        """
+        loop = asyncio.get_running_loop()
+        valid = await loop.run_in_executor(self.hash_pool, self._check_hash, piece.index, piece.get_data())
+
+        if not valid:
+            self.handle_corrupted_piece(piece)
+            return
+
+        try:
+            await self.write_cache.write_piece(piece)
+        except DiskWriteFailed:
+            return  # The download stops, progress_download raises the error
+
+        self.piece_store.piece_completed(piece)
+        self.piece_picker.piece_completed(piece.index)
+        self.progress_event.set()
+        self.requests_event.set()
+        await self.send_have(piece.index)
+        if not self.use_progress_bar:
+            logging.getLogger("BitTorrent").info(
+                "Progress: {have}/{total} Unchoked peers: {peers_have}/{total_peers}".format(
+                    have=self.piece_store.completed_pieces,
+                    total=self.number_of_pieces,
+                    peers_have=self.peer_manager.num_of_unchoked,
+                    total_peers=len(self.peer_manager.connected_peers),
+                )
+            )
+
+    def handle_corrupted_piece(self, piece: Piece):
+        """
+        Record the peers that sent the blocks of the piece, disconnect
+        the ones that sent too many bad pieces, and download the piece again
+        """
+        logging.getLogger("BitTorrent").error(f"Piece {piece.index} failed the hash check")
+        for peer in set(piece.owners):
+            if peer is None:
+                continue
+
+            peer.corrupted_pieces += 1
+            if peer.corrupted_pieces >= CONFIGURATION.max_corrupted_pieces:
+                logging.getLogger("BitTorrent").error(
+                    f"Disconnecting {peer} after {peer.corrupted_pieces} corrupted pieces"
+                )
+                self.peer_manager.remove_peer(peer)
+
+        self.piece_store.reset_piece(piece)
+        self.piece_picker.piece_reset(piece.index)
+        self.endgame = False  # There are free blocks again
+        self.requests_event.set()
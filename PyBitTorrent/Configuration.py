@@ -11,15 +11,34 @@ class Configuration:
         self.max_listening_port: int = 6889
         self.max_peers: int = 12
         self.request_interval: float = 0.2
-        self.iteration_sleep_interval: float = 0.001
+        self.request_queue_depth: int = 5
+        self.max_request_queue_depth: int = 250
+        self.request_queue_time: float = 3.0
+        self.slow_peer_ratio: float = 0.1
+        self.min_request_timeout: float = 0.5
         self.logging_level: int = 100
         self.timeout: float = 3.0
-        self.max_handshake_threads: int = 80
+        self.announce_deadline: float = 15.0
+        self.numwant: int = 50
+        self.max_concurrent_handshakes: int = 80
+        self.hash_workers: int = 2
+        self.max_corrupted_pieces: int = 3
         self.udp_tracker_receive_size: int = 16384
+        self.udp_retransmit_base: float = 15.0
+        self.udp_max_retransmits: int = 8
+        self.receive_buffer_size: int = 262144
+        self.send_buffer_size: int = 1048576
         self.handshake_stripped_size: int = 48
         self.default_connection_id: int = 0X41727101980
         self.compact_value_num_bytes: int = 6
         self.tcp_only: bool = False
+        self.use_mmap: bool = False
+        self.mmap_flush_size: int = 67108864
+        self.mmap_flush_interval: float = 5.0
+        self.write_cache_size: int = 67108864
+        self.write_cache_max_age: float = 5.0
+        self.upload_slots: int = 4
+        self.choke_interval: float = 10.0
 
     def load(self):
         with open(self.path, "r") as config:
@@ -60,3 +60,11 @@ class UnexpectedResponse(BasicException):
 
 class InvalidConfigurationValue(BasicException):
     pass
+
+
+class TrackerError(BasicException):
+    pass
+
+
+class DiskWriteFailed(BasicException):
+    pass
@@ -1,5 +1,7 @@
 import logging
-from typing import List
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, urlunparse
 
 import requests
 
@@ -12,59 +14,141 @@ from PyBitTorrent.Configuration import CONFIGURATION
 
 
 class HTTPTracker(Tracker):
+    # One session per tracker host, so the connections are kept alive between the requests
+    _sessions: Dict[str, requests.Session] = {}
+    _sessions_lock = threading.Lock()
 
-    def get_peers(self, peer_id: bytes, port: int, torrent: TorrentFile) -> List[Peer]:
+    def __init__(self, url):
+        super().__init__(url)
+        self.host = urlparse(url).netloc
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        The pooled session of the tracker host, it asks for
+        gzip responses and decompresses them by itself
+        """
+        with HTTPTracker._sessions_lock:
+            session = HTTPTracker._sessions.get(self.host)
+            if session is None:
+                session = requests.Session()
+                session.headers["Accept-Encoding"] = "gzip"
+                HTTPTracker._sessions[self.host] = session
+
+        return session
+
+    @property
+    def scrape_url(self) -> Optional[str]:
+        """
+        The scrape url is the announce url with 'announce' in its last part
+        replaced by 'scrape', a tracker whose url is different can't be scraped
+        """
+        parsed = urlparse(self.url)
+        head, _, last = parsed.path.rpartition("/")
+        if not last.startswith("announce"):
+            return None
+
+        return urlunparse(parsed._replace(path=f"{head}/scrape{last[len('announce'):]}"))
+
+    def get_peers(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "started",
+    ) -> Optional[List[Peer]]:
         """
         Request from the http tracker all the peers,
         parse them, and then return list containing
-        Peer objects.
+        Peer objects, or None when the announce failed.
         """
-        logging.getLogger("BitTorrent").error(f"Connecting to HTTP Tracker {self.url}")
+        logging.getLogger("BitTorrent").debug(f"Connecting to HTTP Tracker {self.url}")
 
         params = {
             "info_hash": torrent.hash,
             "peer_id": peer_id,
-            "uploaded": 0,
-            "downloaded": 0,
+            "uploaded": uploaded,
+            "downloaded": downloaded,
             "port": port,
-            "left": torrent.length,
-            "event": "started",
-            "timeout": CONFIGURATION.timeout
+            "left": torrent.length if left is None else left,
+            "compact": 1,
+            "numwant": CONFIGURATION.numwant,
         }
+        if event:
+            params["event"] = event
         try:
-            raw_response = requests.get(self.url, params=params).content
-            tracker_response = bdecode(raw_response)
+            raw_response = self.session.get(self.url, params=params, timeout=CONFIGURATION.timeout).content
+            # The peers are binary, only the keys are decoded
+            tracker_response = bdecode(raw_response, decode_strings=False)
             logging.getLogger("BitTorrent").info(f"success in scraping {self.url}")
-            print(tracker_response)
-        except (requests.exceptions.RequestException, TypeError, UnexpectedResponse):
+        except (requests.exceptions.RequestException, TypeError, ValueError, UnexpectedResponse):
             logging.getLogger("BitTorrent").error(f"Failed to scrape {self.url}")
-            return []
+            return None
 
-        peers = []
+        if not isinstance(tracker_response, dict):
+            logging.getLogger("BitTorrent").error(f"Unexpected response from tracker {self.url}")
+            return None
 
-        if "peers" in tracker_response or "peers6" in tracker_response:
-            peers_key = "peers"
-            if "peers6" in tracker_response:
-                peers_key += "6"
+        peers = []
+        self.interval = tracker_response.get("interval", self.interval)
+        self.min_interval = tracker_response.get("min interval", self.min_interval)
+        self.seeders = tracker_response.get("complete", self.seeders)
+        self.leechers = tracker_response.get("incomplete", self.leechers)
 
-            if type(tracker_response[peers_key]) is list:
+        # Only the IPv4 peers, the peers6 of the response can't be connected to
+        if "peers" in tracker_response:
+            if type(tracker_response["peers"]) is list:
                 peers = [
-                    Peer(info["ip"], info["port"], info["peer id"])
-                    for info in tracker_response[peers_key]
+                    Peer(info["ip"].decode(), info["port"], info.get("peer id", "00000000000000000000"))
+                    for info in tracker_response["peers"]
                 ]
             else:
                 logging.getLogger("BitTorrent").info(
                     f"Tracker {self.url} using compact mode"
                 )
-                peers = Tracker.extract_compact_peers(tracker_response[peers_key])
+                peers = Tracker.extract_compact_peers(tracker_response["peers"])
 
         elif "failure reason" in tracker_response:
             logging.getLogger("BitTorrent").error(
-                f'Failure in tracker {self.url}: {tracker_response["failure reason"]}'
+                f'Failure in tracker {self.url}: {tracker_response["failure reason"].decode(errors="replace")}'
             )
-        else:
+            return None
+        elif "peers6" not in tracker_response:
             logging.getLogger("BitTorrent").error(
                 f"Unknown exception in tracker {self.url}"
             )
+            return None
 
         return peers
+
+    def get_scrape(self, torrent: TorrentFile) -> Optional[Dict[str, int]]:
+        """
+        Request the numbers of seeders (complete), leechers (incomplete) and
+        completed downloads (downloaded) of the torrent from the scrape url
+        """
+        scrape_url = self.scrape_url
+        if scrape_url is None:
+            return None
+
+        try:
+            raw_response = self.session.get(
+                scrape_url, params={"info_hash": torrent.hash}, timeout=CONFIGURATION.timeout
+            ).content
+            files = bdecode(raw_response)["files"]
+        except (requests.exceptions.RequestException, TypeError, ValueError, KeyError, UnexpectedResponse):
+            logging.getLogger("BitTorrent").debug(f"Failed to scrape {scrape_url}")
+            return None
+
+        for info_hash, stats in files.items():
+            # bdecode returns the keys it could decode as str
+            if isinstance(info_hash, str):
+                info_hash = info_hash.encode()
+
+            if info_hash == torrent.hash and isinstance(stats, dict):
+                return stats
+
+        return None
+
+    def close(self):
+        with HTTPTracker._sessions_lock:
+            session = HTTPTracker._sessions.pop(self.host, None)
+
+        if session is not None:
+            session.close()
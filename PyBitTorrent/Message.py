@@ -1,10 +1,13 @@
 import enum
+import logging
 import struct
 from abc import ABC, abstractmethod
-from typing import Union
+from typing import Optional, Union
 
 from bitstring import BitArray
 
+from PyBitTorrent.Exceptions import PeerHandshakeFailed
+
 
 class MessageCode(enum.IntEnum):
     CHOKE = 0
@@ -21,7 +24,25 @@ class MessageCode(enum.IntEnum):
     HANDSHAKE = -1
 
 
+# The formats are compiled once, every message is the
+# length prefix and the message id followed by its fields
+HEADER = struct.Struct(">IB")
+HAVE = struct.Struct(">IBI")
+BLOCK = struct.Struct(">IBIII")  # Request and cancel
+BLOCK_PAYLOAD = struct.Struct(">III")
+INDEX_PAYLOAD = struct.Struct(">I")
+PIECE_HEADER = struct.Struct(">IBII")
+PIECE_PAYLOAD_HEADER = struct.Struct(">II")
+PORT = struct.Struct(">IBH")
+PORT_PAYLOAD = struct.Struct(">H")
+HANDSHAKE = struct.Struct(">B19s8s20s20s")
+
+
 class Message(ABC):
+    __slots__ = ()
+    # The length of the messages whose size is fixed, None for the others
+    length: Optional[int] = None
+
     @abstractmethod
     def to_bytes(self) -> bytes:
         pass
@@ -31,6 +52,15 @@ class Message(ABC):
     def from_bytes(payload):
         pass
 
+    def pack_into(self, buffer, offset: int) -> int:
+        """
+        Write the message into the buffer at offset, and return the
+        number of bytes, 4 + length for the messages of a fixed size
+        """
+        data = self.to_bytes()
+        buffer[offset:offset + len(data)] = data
+        return len(data)
+
     def should_wait_for_data(self):
         """
         If the message have data field,
@@ -39,63 +69,106 @@ class Message(ABC):
         return False
 
 
-class Choke(Message):
-    def __init__(self):
-        self.id = MessageCode.CHOKE
-        self.length = 1
+class StatelessMessage(Message):
+    """
+    A message without payload. All its instances would be
+    the same, so there is only one, and its bytes are built once.
+    """
+    __slots__ = ()
+    _instances = {}
+    id: int
+    length = 1
+    encoded: bytes
+
+    def __new__(cls):
+        instance = StatelessMessage._instances.get(cls)
+        if instance is None:
+            instance = StatelessMessage._instances[cls] = super().__new__(cls)
+
+        return instance
 
     def to_bytes(self) -> bytes:
-        return struct.pack(">IB", self.length, self.id)
+        return self.encoded
 
-    @staticmethod
-    def from_bytes(payload):
-        # The choke message contains no relevant values...
-        return Unchoke()
+    def pack_into(self, buffer, offset: int) -> int:
+        buffer[offset:offset + len(self.encoded)] = self.encoded
+        return len(self.encoded)
 
+    @classmethod
+    def from_bytes(cls, payload):
+        # The message contains no relevant values...
+        return cls()
 
-class Unchoke(Message):
-    def __init__(self):
-        self.id = MessageCode.UNCHOKE
-        self.length = 1
 
-    def to_bytes(self) -> bytes:
-        return struct.pack(">IB", self.length, self.id)
+class Choke(StatelessMessage):
+    __slots__ = ()
+    id = MessageCode.CHOKE
+    encoded = HEADER.pack(1, id)
 
-    @staticmethod
-    def from_bytes(payload):
-        # The unchoke message contains no relevant values...
-        return Unchoke()
+
+class Unchoke(StatelessMessage):
+    __slots__ = ()
+    id = MessageCode.UNCHOKE
+    encoded = HEADER.pack(1, id)
+
+
+class Interested(StatelessMessage):
+    __slots__ = ()
+    id = MessageCode.INTERESTED
+    encoded = HEADER.pack(1, id)
+
+
+class NotInterested(StatelessMessage):
+    __slots__ = ()
+    id = MessageCode.NOT_INTERESTED
+    encoded = HEADER.pack(1, id)
+
+
+class KeepAlive(StatelessMessage):
+    __slots__ = ()
+    id = None
+    length = 0
+    encoded = INDEX_PAYLOAD.pack(0)
 
 
 class BitField(Message):
+    __slots__ = ("bitfield",)
+    id = MessageCode.BITFIELD
+
     def __init__(self, bitfield):
         self.bitfield = BitArray(bitfield)
 
     @staticmethod
     def from_bytes(payload):
-        # payload is the bitstring
-        bitfield = BitArray(payload)
-        return BitField(bitfield)
+        # payload is the bitstring, copied as it may be a view of the receive buffer
+        return BitField(bytes(payload))
 
     def to_bytes(self) -> bytes:
-        raise NotImplemented
+        payload = self.bitfield.tobytes()  # Padded with zeros up to full bytes
+        return HEADER.pack(len(payload) + 1, self.id) + payload
 
 
 class Handshake(Message):
+    __slots__ = ("peer_id", "info_hash", "protocol")
+    id = MessageCode.HANDSHAKE
+
     def __init__(
         self, peer_id: bytes, info_hash: bytes, protocol: str = "BitTorrent protocol"
     ):
-        self.id = MessageCode.HANDSHAKE
         self.peer_id = peer_id
         self.info_hash = info_hash
         self.protocol = protocol
 
     def to_bytes(self) -> bytes:
-        protocol_len = len(self.protocol)
+        protocol = self.protocol.encode()
+        if len(protocol) == 19:
+            return HANDSHAKE.pack(19, protocol, b"\x00" * 8, self.info_hash, self.peer_id)
+
+        protocol_len = len(protocol)
         handshake = struct.pack(
             f">B{protocol_len}s8s20s20s",
             protocol_len,
-            self.protocol.encode(),
+            protocol,
             b"\x00" * 8,
             self.info_hash,
             self.peer_id,
@@ -105,14 +178,11 @@ class Handshake(Message):
 
     @staticmethod
     def from_bytes(payload: bytes):
-        if len(payload) != 68:
-            print("Payload error:", payload)
-            return b""
-        protocol_len = struct.unpack(">B", payload[:1])[0]
-        protocol, reserved, info_hash, peer_id = struct.unpack(
-            f">{protocol_len}s8s20s20s", payload[1:]
-        )
+        if len(payload) != HANDSHAKE.size:
+            logging.getLogger("BitTorrent").debug(f"Handshake of {len(payload)} bytes: {bytes(payload)!r}")
+            raise PeerHandshakeFailed
 
+        protocol_len, protocol, reserved, info_hash, peer_id = HANDSHAKE.unpack(payload)
         return Handshake(peer_id, info_hash, protocol)
 
     def __eq__(self, other):
@@ -120,25 +190,53 @@ class Handshake(Message):
 
 
 class Request(Message):
+    __slots__ = ("index", "begin", "piece_length")
+    id = MessageCode.REQUEST
+    length = 13  # bytes
+
     def __init__(self, index, offset, length):
-        self.id = MessageCode.REQUEST
         self.index = index  # 4 byte
         self.begin = offset  # 4 bytes
         self.piece_length = length  # 4 bytes
-        self.length = 13  # bytes
 
     def to_bytes(self) -> bytes:
-        return struct.pack(
-            ">IBIII", self.length, self.id, self.index, self.begin, self.piece_length
-        )
+        return BLOCK.pack(self.length, self.id, self.index, self.begin, self.piece_length)
+
+    def pack_into(self, buffer, offset: int) -> int:
+        BLOCK.pack_into(buffer, offset, self.length, self.id, self.index, self.begin, self.piece_length)
+        return BLOCK.size
+
+    @staticmethod
+    def from_bytes(payload):
+        return Request(*BLOCK_PAYLOAD.unpack(payload))
+
+
+class Cancel(Message):
+    __slots__ = ("index", "begin", "piece_length")
+    id = MessageCode.CANCEL
+    length = 13  # bytes
+
+    def __init__(self, index, offset, length):
+        self.index = index  # 4 byte
+        self.begin = offset  # 4 bytes
+        self.piece_length = length  # 4 bytes
+
+    def to_bytes(self) -> bytes:
+        return BLOCK.pack(self.length, self.id, self.index, self.begin, self.piece_length)
+
+    def pack_into(self, buffer, offset: int) -> int:
+        BLOCK.pack_into(buffer, offset, self.length, self.id, self.index, self.begin, self.piece_length)
+        return BLOCK.size
 
     @staticmethod
     def from_bytes(payload):
-        _, _, index, begin, length = struct.unpack(">IBIII", payload)
-        return Request(index, begin, length)
+        return Cancel(*BLOCK_PAYLOAD.unpack(payload))
 
 
 class PieceMessage(Message):
+    __slots__ = ("index", "offset", "data")
+    id = MessageCode.PIECE
+
     def __init__(self, index, offset, data):
         self.index = index
         self.offset = offset
@@ -147,49 +245,83 @@ class PieceMessage(Message):
     def __str__(self):
         return f"[index: {self.index}, offset: {self.offset}]"
 
+    @staticmethod
+    def header(index, offset, length) -> bytes:
+        """
+        The bytes before the block of a piece message,
+        so the block itself can be sent without copying
+        """
+        return PIECE_HEADER.pack(PIECE_PAYLOAD_HEADER.size + 1 + length, MessageCode.PIECE, index, offset)
+
     @staticmethod
     def from_bytes(payload):
-        index, offset = struct.unpack(">II", payload[:8])
-        data = payload[8:]
+        index, offset = PIECE_PAYLOAD_HEADER.unpack_from(payload)
+        data = memoryview(payload)[PIECE_PAYLOAD_HEADER.size:]
 
         return PieceMessage(index, offset, data)
 
     def to_bytes(self) -> bytes:
-        pass
+        return PieceMessage.header(self.index, self.offset, len(self.data)) + bytes(self.data)
 
     def should_wait_for_data(self):
         return len(self.data) == 0
 
 
 class HaveMessage(Message):
+    __slots__ = ("index",)
+    id = MessageCode.HAVE
+    length = 5
+
     def __init__(self, index):
         self.index = index
 
     @staticmethod
     def from_bytes(payload):
-        index = struct.unpack(">I", payload)[0]
+        index, = INDEX_PAYLOAD.unpack(payload)
 
         return HaveMessage(index)
 
     def to_bytes(self) -> bytes:
-        pass
+        return HAVE.pack(self.length, self.id, self.index)
 
+    def pack_into(self, buffer, offset: int) -> int:
+        HAVE.pack_into(buffer, offset, self.length, self.id, self.index)
+        return HAVE.size
 
-class UnknownMessage(Message):
-    def __init__(self, _id):
-        self.id = _id
 
-    def to_bytes(self) -> bytes:
-        pass
+class Port(Message):
+    """
+    The port of the DHT node of the peer (BEP 5)
+    """
+    __slots__ = ("port",)
+    id = MessageCode.PORT
+    length = 3
+
+    def __init__(self, port):
+        self.port = port
 
     @staticmethod
     def from_bytes(payload):
-        pass
+        port, = PORT_PAYLOAD.unpack(payload)
+
+        return Port(port)
+
+    def to_bytes(self) -> bytes:
+        return PORT.pack(self.length, self.id, self.port)
+
+    def pack_into(self, buffer, offset: int) -> int:
+        PORT.pack_into(buffer, offset, self.length, self.id, self.port)
+        return PORT.size
+
+
+class UnknownMessage(Message):
+    __slots__ = ("id",)
 
+    def __init__(self, _id):
+        self.id = _id
 
-class KeepAlive(Message):
     def to_bytes(self) -> bytes:
-        return struct.pack("I", 0)
+        pass
 
     @staticmethod
     def from_bytes(payload):
@@ -201,10 +333,14 @@ MessageTypes = Union[
     Message,
     Handshake,
     Request,
+    Cancel,
     PieceMessage,
     BitField,
     HaveMessage,
     Unchoke,
     Choke,
+    Interested,
+    NotInterested,
+    Port,
     UnknownMessage,
 ]
@@ -7,8 +7,13 @@ from PyBitTorrent.Message import (
     BitField,
     Choke,
     Unchoke,
+    Interested,
+    NotInterested,
+    Request,
+    Cancel,
     PieceMessage,
     HaveMessage,
+    Port,
 )
 
 
@@ -18,41 +23,27 @@ class MessageFactory:
         if len(payload) == 0:
             return KeepAlive()
 
-        _id = payload[0]
-        if _id not in messages_creators:
-            return UnknownMessage(_id)
+        creator = messages_creators.get(payload[0])
+        if creator is None:
+            return UnknownMessage(payload[0])
 
-        return messages_creators[_id](payload[1:])  # Delete the message id byte
+        return creator(memoryview(payload)[1:])  # Skip the message id byte, without copying
 
     @staticmethod
     def create_handshake_message(payload):
         return Handshake.from_bytes(payload)
 
-    @staticmethod
-    def create_bitfield_message(payload):
-        return BitField.from_bytes(payload)
-
-    @staticmethod
-    def create_choke_message(payload):
-        return Choke.from_bytes(payload)
-
-    @staticmethod
-    def create_unchoke_message(payload):
-        return Unchoke.from_bytes(payload)
-
-    @staticmethod
-    def create_piece_message(payload):
-        return PieceMessage.from_bytes(payload)
-
-    @staticmethod
-    def create_have_message(payload):
-        return HaveMessage.from_bytes(payload)
-
 
+# Every message id to the function that parses its payload
 messages_creators = {
-    MessageCode.BITFIELD: MessageFactory.create_bitfield_message,
-    MessageCode.CHOKE: MessageFactory.create_choke_message,
-    MessageCode.UNCHOKE: MessageFactory.create_unchoke_message,
-    MessageCode.PIECE: MessageFactory.create_piece_message,
-    MessageCode.HAVE: MessageFactory.create_have_message,
+    MessageCode.BITFIELD: BitField.from_bytes,
+    MessageCode.CHOKE: Choke.from_bytes,
+    MessageCode.UNCHOKE: Unchoke.from_bytes,
+    MessageCode.INTERESTED: Interested.from_bytes,
+    MessageCode.NOT_INTERESTED: NotInterested.from_bytes,
+    MessageCode.REQUEST: Request.from_bytes,
+    MessageCode.CANCEL: Cancel.from_bytes,
+    MessageCode.PIECE: PieceMessage.from_bytes,
+    MessageCode.HAVE: HaveMessage.from_bytes,
+    MessageCode.PORT: Port.from_bytes,
 }
@@ -1,7 +1,11 @@
+import asyncio
 import ipaddress
 import logging
 import socket
 import struct
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
 
 from bitstring import BitArray
 
@@ -10,55 +14,161 @@ from PyBitTorrent.Exceptions import (
     PeerDisconnected,
     PeerHandshakeFailed,
 )
-from PyBitTorrent.Message import Message, Handshake, BitField, HaveMessage
+from PyBitTorrent.Block import Block
+from PyBitTorrent.Message import Message, MessageCode, Handshake, BitField, HaveMessage, PieceMessage, PIECE_PAYLOAD_HEADER
 from PyBitTorrent.MessageFactory import MessageFactory
 from PyBitTorrent.Configuration import CONFIGURATION
 
 
+# Message id, piece index and block offset
+PIECE_HEADER_SIZE = 9
+# The length prefix of every message after the handshake
+LENGTH_PREFIX = struct.Struct(">I")  # Big endian integer
+LENGTH_SIZE = LENGTH_PREFIX.size
+# The receive buffer is never smaller, so any handshake fits in it
+MIN_RECEIVE_BUFFER_SIZE = 1024
+
+# Most buffers given to one sendmsg, below IOV_MAX,
+# and most block bytes sent before the control messages
+# queued meanwhile get their turn
+MAX_SEND_BUFFERS = 512
+SEND_BATCH_SIZE = 262144
+# The control messages of a fixed size are packed into a buffer
+# of this size, that every peer reuses for all its writes
+CONTROL_BUFFER_SIZE = 8192
+# Windows sockets have no sendmsg, the buffers are joined there
+SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# The download rate is measured over windows of this number of seconds,
+# and every window moves the rate estimate this much towards its rate
+RATE_WINDOW = 1.0
+RATE_WEIGHT = 0.3
+
+# Weights of every new sample in the round trip time estimate and in its
+# variation, the most the timeout backs off, and its upper bound, as in TCP
+RTT_WEIGHT = 0.125
+RTT_VARIATION_WEIGHT = 0.25
+MAX_TIMEOUT_BACKOFF = 64
+MAX_REQUEST_TIMEOUT = 60
+
+
 class Peer:
 
-    def __init__(self, ip: str, port: int, _id: str = "00000000000000000000"):
+    def __init__(self, ip: str, port: int, _id: str = "00000000000000000000", sock: socket.socket = None):
+        """
+        A remote peer, sock is given for the peers that connected to us
+        """
         self.ip = ip
         self.port = port
         self.id = _id
         self.connected = False  # only after handshake this will be true
         self.handshake = None  # Handshake still have not happened
         self.is_choked = True  # By default the client is choked
+        self.am_interested = False
+        self.corrupted_pieces = 0  # Pieces this peer sent blocks of that failed the hash check
         self.bitfield: BitArray = BitArray()
 
-        if type(ipaddress.ip_address(ip)) is ipaddress.IPv6Address:
+        # Outstanding block requests, (piece index, offset) -> time requested
+        self.pending_requests: Dict[Tuple[int, int], float] = {}
+        self.download_rate = 0.0  # bytes per second, moving average
+        self.rtt: Optional[float] = None  # seconds from requesting a block until it arrived, moving average
+        self.rtt_variation = 0.0
+        self.timeouts = 0  # Requests that took longer than the request timeout
+        self._timeout_backoff = 1
+        self._rate_window_start = time.time()
+        self._rate_window_bytes = 0
+
+        # Given the peer and (index, offset, length) of an incoming block, return the
+        # memory in its piece to receive it into, or None if it can't be received there
+        self.block_buffer: Callable[["Peer", int, int, int], Optional[memoryview]] = None
+        # The received data not parsed yet is _buffer[_start:_end], the
+        # buffer is allocated on the first receive, most peers never connect
+        self._buffer: bytearray = None
+        self._buffer_view: memoryview = None
+        self._start = 0
+        self._end = 0
+
+        # Upload state, the other direction of the connection
+        self.is_interested = False  # The peer is interested in our pieces
+        self.am_choking = True
+        self.upload_requests: Deque[Tuple[int, int, int]] = deque()  # (index, offset, length)
+        self.uploaded = 0
+        self.upload_rate = 0.0  # bytes per second
+        # Called with the size of every block once it was written to the socket
+        self.on_block_sent: Callable[[int], None] = None
+        self._upload_window_start = time.time()
+        self._upload_window_bytes = 0
+        # Messages waiting to be sent, the control messages go before the
+        # blocks of the piece messages, and both are sent by one writer task
+        self._control: Deque[Message] = deque()
+        self._control_buffer: memoryview = None
+        self._blocks: Deque[Tuple[int, List[Union[bytes, memoryview, Tuple]]]] = deque()  # (length, parts)
+        self._queued_block_bytes = 0
+        self._writer: asyncio.Task = None
+        self._send_failed = False
+        # Set when there is room for more blocks, created lazily like the other events
+        self._room: asyncio.Event = None
+
+        if sock is not None:
+            self.socket = sock
+        elif type(ipaddress.ip_address(ip)) is ipaddress.IPv6Address:
             self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        self.socket.settimeout(CONFIGURATION.timeout)
+        # All the IO is done by the event loop, so the socket must never block
+        self.socket.setblocking(False)
 
     def __str__(self):
         return f"{self.id} {self.ip}:{self.port}"
 
-    def connect(self):
+    async def connect(self):
         """
         Connect to the target client
         """
+        loop = asyncio.get_running_loop()
         try:
-            self.socket.connect((self.ip, self.port))
-        except socket.error as e:
+            await asyncio.wait_for(
+                loop.sock_connect(self.socket, (self.ip, self.port)),
+                CONFIGURATION.timeout,
+            )
+        except (socket.error, asyncio.TimeoutError) as e:
             raise PeerConnectionFailed(f"Failed to connect: {str(e)}")
 
-    def do_handshake(self, my_id, info_hash):
+    async def do_handshake(self, my_id, info_hash):
         """
         Do handshake with fellow peer
         """
         self.handshake = Handshake(my_id, info_hash)
-        handshake_bytes = self.handshake.to_bytes()
+        await self._send(self.handshake)
 
-        self.socket.send(handshake_bytes)
+        try:
+            response = await asyncio.wait_for(
+                self.receive_message(), CONFIGURATION.timeout
+            )
+        except asyncio.TimeoutError:
+            raise PeerHandshakeFailed
 
-        response = self.receive_message()
         self.verify_handshake(response)
 
+    async def accept_handshake(self, my_id, info_hash):
+        """
+        Answer the handshake of a peer that connected to us,
+        only if it wants the torrent we have
+        """
+        try:
+            handshake = await asyncio.wait_for(
+                self.receive_message(), CONFIGURATION.timeout
+            )
+        except asyncio.TimeoutError:
+            raise PeerHandshakeFailed
+
+        self.handshake = Handshake(my_id, info_hash)
+        self.verify_handshake(handshake)
+        await self._send(self.handshake)
+
     def verify_handshake(self, handshake):
-        if self.handshake == handshake:
+        if type(handshake) is Handshake and self.handshake == handshake:
             self.connected = True
         else:
             raise PeerHandshakeFailed
@@ -74,68 +184,479 @@ class Peer:
                 f"Have message {have.index} smaller then {self.bitfield.length}"
             )
 
-    def receive_message(self) -> Message:
-        # After handshake
-        # myid = random.randint(0, 65536)
-        try:
-            # print(f"{myid} Waiting for {self}")
-            packet_length = self.socket.recv(1)
+    async def _receive_into(self, view: memoryview):
+        """
+        Fill the given memory with data from the peer
+        """
+        loop = asyncio.get_running_loop()
+        received = 0
+        while received < len(view):
+            try:
+                size = await loop.sock_recv_into(self.socket, view[received:])
+            except OSError:
+                raise PeerDisconnected
+
+            if size == 0:
+                logging.getLogger('BitTorrent').debug(f'Client in ip {self.ip} with id {self.id} disconnected')
+                self.close()
+                raise PeerDisconnected
 
+            received += size
+
+    async def _fill(self):
+        """
+        Receive as much as fits in the buffer with a single recv, after
+        moving the partial message left in it to its beginning
+        """
+        if self._buffer is None:
+            self._buffer = bytearray(max(CONFIGURATION.receive_buffer_size, MIN_RECEIVE_BUFFER_SIZE))
+            self._buffer_view = memoryview(self._buffer)
+
+        if self._start:
+            tail = self._end - self._start
+            self._buffer_view[:tail] = self._buffer_view[self._start:self._end]
+            self._start, self._end = 0, tail
+
+        try:
+            size = await asyncio.get_running_loop().sock_recv_into(self.socket, self._buffer_view[self._end:])
         except OSError:
             raise PeerDisconnected
 
-        if packet_length == b"":
+        if size == 0:
             logging.getLogger('BitTorrent').debug(f'Client in ip {self.ip} with id {self.id} disconnected')
-            self.socket.close()
+            self.close()
             raise PeerDisconnected
 
-        if self.connected:
-            packet_length = packet_length + self.socket.recv(3)
-            while len(packet_length) < 4:
-                odd = 4 - len(packet_length)
-                packet_length = packet_length + self.socket.recv(odd)
-                logging.getLogger("BitTorrent").error(
-                    f"Setting size again in {self}, length: {packet_length}"
-                )
+        self._end += size
 
-            try:
-                length = struct.unpack(">I", packet_length)[0]  # Big endian integer
-            except struct.error:
-                raise struct.error
-            data = self.socket.recv(length)
+    def _block_target(self, index, offset, length) -> memoryview:
+        """
+        The place of the block in its piece buffer when possible, so it
+        is copied there only once. A block that isn't needed there, like
+        a duplicate in endgame mode, gets its own memory.
+        """
+        target = None
+        if self.block_buffer:
+            target = self.block_buffer(self, index, offset, length)
 
-            while len(data) != length:
-                odd = length - len(data)
-                data += self.socket.recv(odd)
+        if target is None:
+            target = memoryview(bytearray(length))
 
+        return target
+
+    def _parse_message(self) -> Optional[Message]:
+        """
+        Take the next message out of the buffer,
+        None if it was not received completely
+        """
+        buffer, start = self._buffer, self._start
+        available = self._end - start
+        if not self.connected:
+            if available < 1:
+                return None
+
+            size = 1 + buffer[start] + CONFIGURATION.handshake_stripped_size
+            if available < size:
+                return None
+
+            self._start = start + size
+            return MessageFactory.create_handshake_message(bytes(buffer[start:start + size]))
+
+        if available < LENGTH_SIZE:
+            return None
+
+        length, = LENGTH_PREFIX.unpack_from(buffer, start)
+        if available < LENGTH_SIZE + length:
+            return None
+
+        start += LENGTH_SIZE
+        self._start = start + length
+        if length >= PIECE_HEADER_SIZE and buffer[start] == MessageCode.PIECE:
+            index, offset = PIECE_PAYLOAD_HEADER.unpack_from(buffer, start + 1)
+            target = self._block_target(index, offset, length - PIECE_HEADER_SIZE)
+            target[:] = self._buffer_view[start + PIECE_HEADER_SIZE:self._start]
+            return PieceMessage(index, offset, target)
+
+        # Parsed straight from the buffer, the messages copy only what they keep
+        return MessageFactory.create_message(self._buffer_view[start:self._start])
+
+    async def _receive_rest(self) -> Optional[Message]:
+        """
+        Receive the rest of a message that is partly in the buffer, when it is
+        a piece message whose header arrived, straight into its piece, or a
+        message too long for the buffer into its own memory. None for any
+        other message.
+        """
+        available = self._end - self._start
+        if not self.connected or available < LENGTH_SIZE:
+            return None
+
+        length, = LENGTH_PREFIX.unpack_from(self._buffer, self._start)
+        start = self._start + LENGTH_SIZE
+        available -= LENGTH_SIZE
+        if length >= PIECE_HEADER_SIZE and available >= PIECE_HEADER_SIZE and self._buffer[start] == MessageCode.PIECE:
+            index, offset = PIECE_PAYLOAD_HEADER.unpack_from(self._buffer, start + 1)
+            target = self._block_target(index, offset, length - PIECE_HEADER_SIZE)
+            received = available - PIECE_HEADER_SIZE
+            target[:received] = self._buffer_view[start + PIECE_HEADER_SIZE:self._end]
+            self._start = self._end = 0
+            await self._receive_into(target[received:])
+            return PieceMessage(index, offset, target)
+
+        if LENGTH_SIZE + length > len(self._buffer):
+            data = bytearray(length)
+            data[:available] = self._buffer_view[start:self._end]
+            self._start = self._end = 0
+            await self._receive_into(memoryview(data)[available:])
             return MessageFactory.create_message(data)
 
-        else:
-            protocol_len: int = struct.unpack(">B", packet_length)[0]
-            handshake_bytes = self.socket.recv(protocol_len + CONFIGURATION.handshake_stripped_size)
+        return None
 
-            return MessageFactory.create_handshake_message(
-                packet_length + handshake_bytes
-            )
+    async def receive_message(self) -> Message:
+        """
+        Receive the next message, the handshake before the peer is connected
+        """
+        message = self._parse_message()
+        while message is None:
+            if self._buffer is not None:
+                message = await self._receive_rest()
+                if message is not None:
+                    return message
+
+            await self._fill()
+            message = self._parse_message()
+
+        return message
 
-    def send_message(self, message: Message):
+    async def receive_messages(self) -> List[Message]:
+        """
+        Receive the next message, and all the messages received
+        along with it. A recv reads up to receive_buffer_size bytes,
+        which are many messages when the peer sends fast.
+        """
+        messages = [await self.receive_message()]
+        message = self._parse_message()
+        while message is not None:
+            messages.append(message)
+            message = self._parse_message()
+
+        return messages
+
+    async def _send(self, message: Message):
+        """
+        Send the message, and wait until it and everything
+        queued before it was written to the socket
+        """
+        self._queue_control(message)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Wait until all the queued messages were written to the socket
+        """
+        while self._writer is not None and not self._writer.done():
+            await asyncio.wait([self._writer])
+
+        if self._send_failed:
+            raise PeerDisconnected
+
+    def _queue_control(self, message: Message):
+        if self._send_failed:
+            raise PeerDisconnected
+
+        self._control.append(message)
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_queued())
+
+    async def send_piece(self, index, offset, parts: List[Union[memoryview, Tuple]]):
+        """
+        Queue a block to send without copying it: parts are memory
+        to send as is, or (file, offset, count) to send straight
+        from the file with sendfile. Waits while send_buffer_size
+        bytes of blocks are already queued, until the peer reads them.
+        """
+        if self._room is None:
+            self._room = asyncio.Event()
+
+        while self._queued_block_bytes >= CONFIGURATION.send_buffer_size and not self._send_failed:
+            self._room.clear()
+            await self._room.wait()
+
+        if self._send_failed:
+            raise PeerDisconnected
+
+        length = sum(len(part) if not isinstance(part, tuple) else part[2] for part in parts)
+        self._blocks.append((length, [PieceMessage.header(index, offset, length)] + parts))
+        self._queued_block_bytes += length
+        self._start_writer()
+
+    async def send_message(self, message: Message):
+        """
+        Queue the message, it is sent along with all the
+        messages queued until the writer gets to run
+        """
         # logging.getLogger('BitTorrent').debug(f'Sending message {type(message)} to {self}')
-        if not self.connected:
-            pass
-        message_bytes = message.to_bytes()
+        self._queue_control(message)
+
+    async def _write_queued(self):
+        """
+        Write the queued messages until none is left. Every round takes all
+        the control messages, and then blocks up to SEND_BATCH_SIZE bytes,
+        and writes them together with as few syscalls as possible.
+        """
         try:
-            self.socket.send(message_bytes)
-        except OSError:
-            raise PeerDisconnected
+            while self._control or self._blocks:
+                buffers = self._take_control()
+
+                sent_blocks = []
+                batch_size = 0
+                while self._blocks and batch_size < SEND_BATCH_SIZE and len(buffers) < MAX_SEND_BUFFERS:
+                    length, parts = self._blocks.popleft()
+                    buffers.extend(parts)
+                    sent_blocks.append(length)
+                    batch_size += length
+
+                await self._write_parts(buffers)
+                for length in sent_blocks:
+                    self._queued_block_bytes -= length
+                    self.block_sent(length)
+
+                if self._room is not None and self._queued_block_bytes < CONFIGURATION.send_buffer_size:
+                    self._room.set()
+
+        except (OSError, ValueError) as e:  # ValueError when the socket was closed
+            logging.getLogger("BitTorrent").debug(f"Failed to send to {self}: {e!r}")
+            self._fail_sending()
+
+    def _take_control(self) -> List[Union[bytes, memoryview]]:
+        """
+        Take the queued control messages for the next write. The messages
+        of a fixed size are packed one after another into the control
+        buffer, the others like the bitfield are written from their bytes.
+        What doesn't fit in the buffer waits for the next write.
+        """
+        if self._control_buffer is None:
+            self._control_buffer = memoryview(bytearray(CONTROL_BUFFER_SIZE))
+
+        buffer = self._control_buffer
+        buffers = []
+        start = offset = 0
+        # One buffer is kept for the packed messages that are left
+        while self._control and len(buffers) < MAX_SEND_BUFFERS - 1:
+            message = self._control[0]
+            if message.length is None:
+                if offset > start:
+                    buffers.append(buffer[start:offset])
+                    start = offset
+
+                buffers.append(message.to_bytes())
+            elif offset + 4 + message.length <= len(buffer):
+                offset += message.pack_into(buffer, offset)
+            else:
+                break
+
+            self._control.popleft()
+
+        if offset > start:
+            buffers.append(buffer[start:offset])
+
+        return buffers
+
+    async def _write_parts(self, parts: List[Union[bytes, memoryview, Tuple]]):
+        """
+        Write the memory parts with sendmsg, many at a time, and
+        the (file, offset, count) parts with sendfile in between
+        """
+        loop = asyncio.get_running_loop()
+        buffers = []
+        for part in parts:
+            if not isinstance(part, tuple):
+                buffers.append(part)
+                continue
+
+            await self._write_buffers(buffers)
+            buffers = []
+            file, file_offset, count = part
+            await loop.sock_sendfile(self.socket, file, file_offset, count)
+
+        await self._write_buffers(buffers)
+
+    async def _write_buffers(self, buffers: List[Union[bytes, memoryview]]):
+        """
+        Write all the buffers, continuing after partial writes,
+        and waiting for the socket to be writable when it is full
+        """
+        start = 0
+        while start < len(buffers):
+            try:
+                if SENDMSG:
+                    sent = self.socket.sendmsg(buffers[start:start + MAX_SEND_BUFFERS])
+                else:
+                    sent = self.socket.send(b"".join(buffers[start:start + MAX_SEND_BUFFERS]))
+            except (BlockingIOError, InterruptedError):
+                await self._writable()
+                continue
+
+            # Skip the buffers that were sent, and what was sent of the next one
+            while start < len(buffers) and sent >= len(buffers[start]):
+                sent -= len(buffers[start])
+                start += 1
+
+            if sent:
+                buffers[start] = memoryview(buffers[start])[sent:]
+
+    async def _writable(self):
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+
+        def on_writable():
+            if not writable.done():
+                writable.set_result(None)
+
+        loop.add_writer(self.socket, on_writable)
+        try:
+            await writable
+        finally:
+            loop.remove_writer(self.socket)
+
+    def _fail_sending(self):
+        """
+        Drop the queued messages, the next
+        send raises PeerDisconnected
+        """
+        self._send_failed = True
+        self._control.clear()
+        self._blocks.clear()
+        self._queued_block_bytes = 0
+        if self._room is not None:
+            self._room.set()
+
+    def close(self):
+        self.connected = False
+        self._fail_sending()
+        if self._writer is not None:
+            self._writer.cancel()
+
+        self.socket.close()
 
     def set_choked(self):
         self.is_choked = True
+        # Choking discards all the requests the peer did not answer yet
+        self.pending_requests.clear()
 
     def set_unchoked(self):
         self.is_choked = False
 
-    def have_piece(self, piece):
-        if piece.index < self.bitfield.length:
-            return self.bitfield[piece.index]
+    def have_piece(self, index):
+        if index < self.bitfield.length:
+            return self.bitfield[index]
         else:
             return False
+
+    def add_request(self, index, offset):
+        self.pending_requests[(index, offset)] = time.time()
+
+    def block_received(self, index, offset, size):
+        """
+        Remove the block from the outstanding requests, and
+        account it in the download rate and round trip time
+        """
+        now = time.time()
+        time_requested = self.pending_requests.pop((index, offset), None)
+        if time_requested is not None:
+            self._add_rtt_sample(now - time_requested)
+
+        self._rate_window_bytes += size
+        self.update_rate(now)
+
+    def _add_rtt_sample(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_variation = sample / 2
+        else:
+            self.rtt_variation += RTT_VARIATION_WEIGHT * (abs(self.rtt - sample) - self.rtt_variation)
+            self.rtt += RTT_WEIGHT * (sample - self.rtt)
+
+        self._timeout_backoff = 1
+
+    @property
+    def request_timeout(self) -> float:
+        """
+        How long to wait for a requested block, computed from the round
+        trip time and its variation like the TCP retransmission timeout,
+        and doubled after every timeout until a block arrives in time.
+        Before the first block arrives, the max waiting time of a block.
+        """
+        if self.rtt is None:
+            return Block.max_waiting_time
+
+        timeout = (self.rtt + 4 * self.rtt_variation) * self._timeout_backoff
+        return min(max(timeout, CONFIGURATION.min_request_timeout), MAX_REQUEST_TIMEOUT)
+
+    def update_rate(self, now=None):
+        """
+        Close the rate window if it is over. Called for the idle
+        peers too, so the rate of a peer that stopped sending drops.
+        """
+        now = now or time.time()
+        elapsed = now - self._rate_window_start
+        if elapsed >= RATE_WINDOW:
+            sample = self._rate_window_bytes / elapsed
+            self.download_rate += RATE_WEIGHT * (sample - self.download_rate)
+            self._rate_window_start = now
+            self._rate_window_bytes = 0
+
+    def block_sent(self, size):
+        """
+        Account the size of a block we uploaded in the upload rate
+        """
+        self.uploaded += size
+        if self.on_block_sent:
+            self.on_block_sent(size)
+
+        now = time.time()
+        self._upload_window_bytes += size
+        elapsed = now - self._upload_window_start
+        if elapsed >= 1:
+            self.upload_rate = self._upload_window_bytes / elapsed
+            self._upload_window_start = now
+            self._upload_window_bytes = 0
+
+    def expire_requests(self) -> List[Tuple[int, int]]:
+        """
+        Forget the requests that waited more than the request timeout and
+        return them, so they can be requested from other peers. A peer
+        that times out has its rate estimate halved, so it gets less requests.
+        """
+        deadline = time.time() - self.request_timeout
+        expired = []
+        # The requests are ordered by the time they were sent
+        for request, time_requested in self.pending_requests.items():
+            if time_requested > deadline:
+                break
+
+            expired.append(request)
+
+        if not expired:
+            return expired
+
+        for request in expired:
+            del self.pending_requests[request]
+
+        self.timeouts += len(expired)
+        self._timeout_backoff = min(self._timeout_backoff * 2, MAX_TIMEOUT_BACKOFF)
+        self.download_rate /= 2
+        return expired
+
+    @property
+    def request_queue_depth(self) -> int:
+        """
+        Number of requests to keep outstanding, enough to cover the
+        bandwidth-delay product: request_queue_time seconds of data
+        in the peer's measured download rate.
+        """
+        depth = int(self.download_rate * CONFIGURATION.request_queue_time / Block.default_size)
+        return max(CONFIGURATION.request_queue_depth, min(depth, CONFIGURATION.max_request_queue_depth))
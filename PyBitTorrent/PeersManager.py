@@ -1,18 +1,14 @@
+import asyncio
 import logging
-import math
-import random
-import select
 import socket
-import threading
-from typing import List, Dict
+import struct
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
 
 from PyBitTorrent.Exceptions import (
     PeerConnectionFailed,
     PeerDisconnected,
     OutOfPeers,
-    NoPeersHavePiece,
     PeerHandshakeFailed,
-    AllPeersChocked,
 )
 from PyBitTorrent.Message import MessageTypes
 from PyBitTorrent.Peer import Peer
@@ -24,12 +20,32 @@ class PeersManager:
         self.max_peers = max_peers
         self.peers: List[Peer] = []
         self.connected_peers: List[Peer] = []
+        self.pending_handshakes = 0
+        self.accepting = False  # Peers may still connect to us
+        self.searching = False  # The trackers may still send peers
+        # Set when peers are added, created lazily like the messages queue
+        self._new_peers: asyncio.Event = None
+        self._connecting: Set[Tuple[str, int]] = set()  # Addresses of the peers in the middle of a handshake
+        # Addresses of the peers left out because there were enough, connected when others disconnect
+        self.reserve: List[Tuple[str, int]] = []
+        # Created lazily, the queue must belong to the running event loop
+        self.messages: asyncio.Queue = None
+        self._receivers: Set[asyncio.Task] = set()
+        # Called with every connected peer that gets removed
+        self.on_peer_removed: Callable[[Peer], None] = None
+        # Given to every connected peer, see Peer.block_buffer
+        self.block_buffer: Callable[[Peer, int, int, int], Optional[memoryview]] = None
+        # Given to every connected peer, see Peer.on_block_sent
+        self.on_block_sent: Callable[[int], None] = None
+        # Awaited with every new connected peer, before receiving its messages
+        self.on_peer_connected: Callable[[Peer], Awaitable] = None
 
     def add_peers(self, peers: List[Peer]):
         """
         Add peer to the list (still not connected)
         """
         self.peers += peers
+        self._get_new_peers_event().set()
 
     def remove_peer(self, peer):
         """
@@ -41,142 +57,257 @@ class PeersManager:
         """
         if peer in self.connected_peers:
             self.connected_peers.remove(peer)
+            peer.close()
+            if self.on_peer_removed:
+                self.on_peer_removed(peer)
+
+            self._top_up()
+
+    def _top_up(self):
+        """
+        Connect to peers from the reserve, until
+        there are max peers connected again
+        """
+        missing = self.max_peers - len(self.connected_peers) - self.pending_handshakes - len(self.peers)
+        if missing <= 0 or not self.reserve:
+            return
+
+        addresses, self.reserve = self.reserve[:missing], self.reserve[missing:]
+        self.add_peers([Peer(ip, port) for ip, port in addresses])
+
+    def needs_peers(self) -> bool:
+        """
+        Check if there are less than max peers, and no
+        more known peers to connect to instead
+        """
+        return (
+            len(self.connected_peers) + self.pending_handshakes < self.max_peers
+            and not self.peers and not self.reserve
+        )
 
     def add_peer(self, peer: Peer):
         """
         Add peer to the list (still not connected)
         """
         self.peers.append(peer)
+        self._get_new_peers_event().set()
+
+    def _get_new_peers_event(self) -> asyncio.Event:
+        if self._new_peers is None:
+            self._new_peers = asyncio.Event()
+
+        return self._new_peers
 
-    def _send_handshake(self, my_id, info_hash, peer):
+    def _get_messages_queue(self) -> asyncio.Queue:
+        if self.messages is None:
+            self.messages = asyncio.Queue()
+
+        return self.messages
+
+    async def _send_handshake(self, my_id, info_hash, peer):
         """
-        Send handshake to the given peer.
-        NOTE: this function is BLOCKING.
+        Connect to the given peer and send handshake to it.
         it waits until handshake response received, and failed otherwise.
+        On success, start receiving messages from the peer.
         """
         try:
-            peer.connect()
+            await peer.connect()
         except PeerConnectionFailed:
+            peer.close()
             return
         try:
             # Send the handshake to peer
             logging.getLogger('BitTorrent').info(f'Trying handshake with peer {peer.ip}')
 
-            peer.do_handshake(my_id, info_hash)
-
-            # Consider it as connected client
-            self.connected_peers.append(peer)
-
-            logging.getLogger("BitTorrent").debug(
-                f"Adding peer {peer} which is {len(self.connected_peers)}/{self.max_peers}"
-            )
+            await peer.do_handshake(my_id, info_hash)
 
         except (PeerHandshakeFailed, PeerDisconnected, socket.error):
-            pass
-
-    def send_handshakes(self, my_id, info_hash):
-        """
-        Send handshake to all clients by create polls of threads
-        That each one of them sending handshake to a constant number
-        of peers. MAX_HANDSHAKE_THREADS decide the max peers to send
-        handshake in each thread. big value will cause long run time
-        for each thread and less threads, small value will cause for
-        less run time to each thread and bigger number of threads.
-        """
-        # Create handshake thread for each peer
-        handshake_threads = []
-        for peer in self.peers:
-            thread = threading.Thread(
-                target=self._send_handshake, args=(my_id, info_hash, peer)
-            )
-            handshake_threads.append(thread)
+            peer.close()
+            return
 
-        number_of_polls = int(len(handshake_threads) / CONFIGURATION.max_handshake_threads) + 1
+        if not await self._add_connected_peer(peer):
+            self.reserve.append((peer.ip, peer.port))
 
-        for i in range(1, number_of_polls + 1):
-            logging.getLogger("BitTorrent").debug(f"Poll number {i}/{number_of_polls}")
-            poll = handshake_threads[:CONFIGURATION.max_handshake_threads]
+    async def _add_connected_peer(self, peer: Peer) -> bool:
+        """
+        Consider the peer as connected client and start receiving its
+        messages, unless there are enough peers. Return if it was added.
+        """
+        if len(self.connected_peers) >= self.max_peers:
+            peer.close()
+            return False
+
+        self.connected_peers.append(peer)
+        peer.block_buffer = self.block_buffer
+        peer.on_block_sent = self.on_block_sent
+        if self.on_peer_connected:
+            await self.on_peer_connected(peer)
+            if peer not in self.connected_peers:
+                return True  # Disconnected meanwhile
+
+        receiver = asyncio.ensure_future(self._receive_from_peer(peer))
+        self._receivers.add(receiver)
+        receiver.add_done_callback(self._receivers.discard)
+
+        logging.getLogger("BitTorrent").debug(
+            f"Adding peer {peer} which is {len(self.connected_peers)}/{self.max_peers}"
+        )
+        return True
 
-            # Execute threads
-            for thread in poll:
-                thread.start()
+    async def _accept_handshake(self, my_id, info_hash, peer: Peer):
+        try:
+            await peer.accept_handshake(my_id, info_hash)
+        except (PeerHandshakeFailed, PeerDisconnected, socket.error):
+            peer.close()
+            return
+        finally:
+            self.pending_handshakes -= 1
 
-            # Wait for them to finish
-            for thread in poll:
-                thread.join()
+        logging.getLogger("BitTorrent").info(f"Peer {peer.ip} connected to us")
+        await self._add_connected_peer(peer)
 
-            if len(self.connected_peers) >= self.max_peers:
-                logging.getLogger("BitTorrent").info(
-                    f"Reached max connected peers of {self.max_peers}"
-                )
-                break
+    async def accept_peers(self, listener_socket: socket.socket, my_id, info_hash):
+        """
+        Accept the peers connecting to the listener socket, and
+        answer their handshakes alongside the other coroutines
+        """
+        loop = asyncio.get_running_loop()
+        handshakes = set()
+        self.accepting = True
+        try:
+            while True:
+                connection, address = await loop.sock_accept(listener_socket)
+                connection.setblocking(False)
+                if len(self.connected_peers) >= self.max_peers:
+                    connection.close()
+                    continue
+
+                peer = Peer(address[0], address[1], sock=connection)
+                self.pending_handshakes += 1
+                handshake = asyncio.ensure_future(self._accept_handshake(my_id, info_hash, peer))
+                handshakes.add(handshake)
+                handshake.add_done_callback(handshakes.discard)
+        finally:
+            self.accepting = False
+            for handshake in list(handshakes):
+                handshake.cancel()
+
+    async def send_handshakes(self, my_id, info_hash):
+        """
+        Send handshake to the peers concurrently, as soon as they are
+        added, each handshake is a coroutine of the event loop so no
+        thread is needed. MAX_CONCURRENT_HANDSHAKES decide how many
+        connections can be in the middle of the handshake at the same
+        time. Runs until cancelled, so peers the trackers send later
+        are connected too.
+        """
+        semaphore = asyncio.Semaphore(CONFIGURATION.max_concurrent_handshakes)
+        new_peers = self._get_new_peers_event()
+        handshakes: Set[asyncio.Future] = set()
 
-            # Slice the handshake threads
-            del handshake_threads[:CONFIGURATION.max_handshake_threads]
+        async def handshake(peer, address):
+            try:
+                async with semaphore:
+                    if len(self.connected_peers) >= self.max_peers:
+                        peer.close()
+                        self.reserve.append(address)
+                        return
 
-        logging.getLogger("BitTorrent").info(
-            f"Total peers connected: {len(self.connected_peers)}"
-        )
+                    await self._send_handshake(my_id, info_hash, peer)
+            finally:
+                self.pending_handshakes -= 1
+                self._connecting.discard(address)
 
-    def receive_messages(self) -> Dict[Peer, MessageTypes]:
+        try:
+            while True:
+                new_peers.clear()
+                peers, self.peers = self.peers, []
+                connected = {(peer.ip, peer.port) for peer in self.connected_peers}
+                for peer in peers:
+                    # The trackers often send the same peers
+                    address = (peer.ip, peer.port)
+                    if address in connected or address in self._connecting or address in self.reserve:
+                        peer.close()
+                        continue
+
+                    self._connecting.add(address)
+                    self.pending_handshakes += 1
+                    task = asyncio.ensure_future(handshake(peer, address))
+                    handshakes.add(task)
+                    task.add_done_callback(handshakes.discard)
+
+                await new_peers.wait()
+        finally:
+            for task in list(handshakes):
+                task.cancel()
+
+    async def _receive_from_peer(self, peer: Peer):
         """
-        Receive new messages from clients
+        Receive messages from the given peer for as long as it is
+        connected, and queue them for the client, a batch at a time
+        """
+        messages = self._get_messages_queue()
+        try:
+            while True:
+                messages.put_nowait((peer, await peer.receive_messages()))
+        except (PeerDisconnected, struct.error, socket.error):
+            logging.getLogger("BitTorrent").debug(
+                f"Peer {peer} while waiting for message"
+            )
+            self.remove_peer(peer)
+        except Exception as e:
+            # A peer that breaks its receiver must not be left connected without one
+            logging.getLogger("BitTorrent").error(f"Receiving from peer {peer} failed: {e!r}")
+            self.remove_peer(peer)
+
+    async def receive_messages(self) -> List[Tuple[Peer, MessageTypes]]:
+        """
+        Receive new messages from clients.
+        Wait for the first message, and then take all
+        the messages that already arrived along with it.
         """
 
         # First, check if we out of peers
-        if len(self.connected_peers) == 0:
+        if (
+            not self.connected_peers and not self.pending_handshakes and not self.peers
+            and not self.accepting and not self.searching
+        ):
             raise OutOfPeers
 
-        # Check for new readable sockets from the connected peers
-        sockets = [peer.socket for peer in self.connected_peers] # The bug resides in here...
-        readable, _, _ = select.select(sockets, [], [])
+        messages = self._get_messages_queue()
+        try:
+            peer, batch = await asyncio.wait_for(messages.get(), CONFIGURATION.timeout)
+        except asyncio.TimeoutError:
+            return []
 
-        peers_to_message = {}
-        # Extract peer from given sockets
-        for _peer in self.connected_peers:
-            for should_read in readable:
-                if _peer.socket == should_read:
-                    peers_to_message[_peer] = None
+        peers_to_messages = [(peer, message) for message in batch]
+        while not messages.empty():
+            peer, batch = messages.get_nowait()
+            peers_to_messages.extend((peer, message) for message in batch)
 
-        # Receive messages from all the given peers
-        for peer in peers_to_message:
-            try:
-                message = peer.receive_message()
-                peers_to_message[peer] = message
-            except PeerDisconnected:
-                logging.getLogger("BitTorrent").debug(
-                    f"Peer {peer} while waiting for message"
-                )
-                self.remove_peer(peer)
-                return self.receive_messages()
+        return peers_to_messages
 
-        return peers_to_message
-
-    def get_random_peer_by_piece(self, piece):
+    def close(self):
         """
-        Get random peer having the given piece
-        Will check at the beginning if all peers are choked,
-        And choose randomly one of the peers that have the
-        piece (By looking at each peer bitfiled).
+        Stop receiving and disconnect from all the peers
         """
-        peers_have_piece = []
-
-        # Check if all the peers choked
-        all_is_chocked = math.prod([peer.is_choked for peer in self.connected_peers])
-        if all_is_chocked:
-            raise AllPeersChocked  # If they are, then even if they have the piece it's not relevant
+        for receiver in list(self._receivers):
+            receiver.cancel()
 
-        # Check from all the peers who have the piece
-        for peer in self.connected_peers:
-            if peer.have_piece(piece) and not peer.is_choked:
-                peers_have_piece.append(peer)
+        for peer in list(self.connected_peers):
+            self.remove_peer(peer)
 
-        # If we left with any peers, shuffle from them
-        if peers_have_piece:
-            return random.choice(peers_have_piece)
+    def peers_by_capacity(self) -> List[Peer]:
+        """
+        The unchoked peers, from the fastest to the slowest
+        by their measured download rate
+        """
+        peers = [peer for peer in self.connected_peers if not peer.is_choked]
+        for peer in peers:
+            peer.update_rate()
 
-        # If we reached so far... then no peer founded
-        raise NoPeersHavePiece
+        peers.sort(key=lambda peer: peer.download_rate, reverse=True)
+        return peers
 
     @property
     def num_of_unchoked(self):
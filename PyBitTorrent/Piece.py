@@ -1,38 +1,49 @@
-from typing import List, Union
+from array import array
+from typing import Iterator, List, Union
 
-from PyBitTorrent.Block import Block, BlockStatus, create_blocks
+from PyBitTorrent.Block import Block, BlockStatus
 from PyBitTorrent.Exceptions import PieceIsPending, PieceIsFull
 
 
 class Piece:
     def __init__(self, index, size):
+        """
+        The blocks state is kept in packed arrays indexed by the
+        block position, Block objects are only views over them.
+        """
         self.index = index
         self.size = size
-        self.blocks: List[Block] = create_blocks(self.size)
+        self.number_of_blocks = -(-size // Block.default_size)
+        self.block_status = bytearray([BlockStatus.FREE]) * self.number_of_blocks
+        self.requested_at = array("d", [0.0]) * self.number_of_blocks
+        self.owners: List = [None] * self.number_of_blocks  # Peer each block was requested from
+        self.data = bytearray(size)
+        # Maintained by the PieceStore on every block status change
+        self.free_blocks = self.number_of_blocks
+        self.full_blocks = 0
 
     def __str__(self):
         return f"[{self.index}]"
 
+    @property
+    def blocks(self) -> List[Block]:
+        return [Block(self, position) for position in range(self.number_of_blocks)]
+
     def is_full(self):
+        return self.full_blocks == self.number_of_blocks
+
+    def get_free_blocks(self) -> Iterator[Block]:
         """
-        Iterate over the blocks and
-        check if they are all fulls
+        Yield the free blocks, searching the status array
         """
-        for block in self.blocks:
-            if block.status != BlockStatus.FULL:
-                return False
-
-        return True
+        position = self.block_status.find(BlockStatus.FREE)
+        while position != -1:
+            yield Block(self, position)
+            position = self.block_status.find(BlockStatus.FREE, position + 1)
 
     def get_free_block(self) -> Union[Block, None]:
-        """
-        Iterate over the blocks and
-        check if of them is free
-        """
-        for block in self.blocks:
-            block.calculate_status()
-            if block.status == BlockStatus.FREE:
-                return block
+        for block in self.get_free_blocks():
+            return block
 
         if self.is_full():
             raise PieceIsFull
@@ -41,44 +52,27 @@ class Piece:
 
     def get_block_by_offset(self, offset):
         """
-        Iterate over the blocks and check if
-        one of them match the given offset
-        """
-        for block in self.blocks:
-            if block.offset == offset:
-                return block
-
-        raise PieceIsPending
-
-    def get_data(self):
-        """
-        Concat the data in all the blocks to
-        retrieve the full data of the piece
+        All the blocks but the last have the default
+        size, so the offset gives the block position
         """
-        data = b""
-        for block in self.blocks:
-            data += block.data
-
-        return data
-
+        position, remainder = divmod(offset, Block.default_size)
+        if remainder or position >= self.number_of_blocks:
+            raise PieceIsPending
 
-def create_pieces(file_size, piece_size) -> List[Piece]:
-    """
-    Create list of empty pieces for the given
-    file_size and the given piece_size
-    """
-    pieces: List[Piece] = []
-    pieces_amount = int(file_size / piece_size)
+        return Block(self, position)
 
-    # Generate pieces
-    for i in range(pieces_amount):
-        piece = Piece(i, piece_size)
-        pieces.append(piece)
+    def get_block_buffer(self, block: Block) -> memoryview:
+        return memoryview(self.data)[block.offset:block.offset + block.size]
 
-    last_piece_size = file_size % piece_size
+    def set_block_data(self, block: Block, data):
+        if isinstance(data, memoryview) and data.obj is self.data:
+            return  # Received in place
 
-    if last_piece_size:
-        last_piece = Piece(pieces_amount, last_piece_size)
-        pieces.append(last_piece)
+        self.data[block.offset:block.offset + block.size] = data
 
-    return pieces
+    def get_data(self):
+        """
+        The blocks are written in place, so the
+        buffer already holds the full piece
+        """
+        return self.data
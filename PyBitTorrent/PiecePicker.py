@@ -0,0 +1,146 @@
+import random
+from array import array
+from typing import Dict, Iterator, List, Set
+
+from bitstring import BitArray
+
+
+def random_rotation(items: List[int]) -> Iterator[int]:
+    """
+    Yield the items starting from a random position and wrapping
+    around, without copying them. The list may shrink meanwhile.
+    """
+    if not items:
+        return
+
+    start = random.randrange(len(items))
+    for step in range(len(items)):
+        if not items:
+            return
+
+        yield items[(start + step) % len(items)]
+
+
+class PiecePicker:
+    def __init__(self, number_of_pieces: int, sequential: bool = False):
+        """
+        Keep the availability of each piece in the swarm,
+        meaning how many of the connected peers have it,
+        and decide which pieces to request first.
+        """
+        self.number_of_pieces = number_of_pieces
+        self.sequential = sequential
+        self.availability = array("I", [0]) * number_of_pieces
+
+        # Pieces no block of which was requested yet, grouped by availability.
+        # The pieces nobody has are not kept. Each piece's position in its
+        # bucket list is kept, so it is removed by swapping it with the last.
+        self.buckets: Dict[int, List[int]] = {}
+        self._positions = array("I", [0]) * number_of_pieces
+        self.started: Set[int] = set()
+        self.completed: Set[int] = set()
+        self._first_missing = 0  # Used by the sequential mode
+
+    def _is_fresh(self, index) -> bool:
+        return index not in self.started and index not in self.completed
+
+    def _change_availability(self, index, delta):
+        if index >= self.number_of_pieces:
+            return  # The bitfield is padded up to full bytes
+
+        availability = self.availability[index]
+        self.availability[index] = availability + delta
+        if not self._is_fresh(index):
+            return
+
+        self._remove_from_bucket(index, availability)
+        self._add_to_bucket(index, availability + delta)
+
+    def add_bitfield(self, bitfield: BitArray):
+        for index in bitfield.findall([1]):
+            self._change_availability(index, 1)
+
+    def remove_bitfield(self, bitfield: BitArray):
+        """
+        Used when a peer disconnects, or replaces its bitfield
+        """
+        for index in bitfield.findall([1]):
+            self._change_availability(index, -1)
+
+    def add_have(self, index):
+        self._change_availability(index, 1)
+
+    def _add_to_bucket(self, index, availability):
+        if availability:
+            bucket = self.buckets.setdefault(availability, [])
+            self._positions[index] = len(bucket)
+            bucket.append(index)
+
+    def _remove_from_bucket(self, index, availability):
+        if not availability:
+            return
+
+        bucket = self.buckets[availability]
+        last = bucket.pop()
+        if last != index:
+            position = self._positions[index]
+            bucket[position] = last
+            self._positions[last] = position
+
+        if not bucket:
+            del self.buckets[availability]
+
+    def piece_started(self, index):
+        if self._is_fresh(index):
+            self._remove_from_bucket(index, self.availability[index])
+            self.started.add(index)
+
+    def piece_completed(self, index):
+        if self._is_fresh(index):
+            self._remove_from_bucket(index, self.availability[index])
+
+        self.started.discard(index)
+        self.completed.add(index)
+
+        while self._first_missing in self.completed:
+            self._first_missing += 1
+
+    def piece_reset(self, index):
+        """
+        Return a piece to the fresh pieces, for example after
+        its data was found to be corrupted
+        """
+        if self._is_fresh(index):
+            return
+
+        self.started.discard(index)
+        self.completed.discard(index)
+        self._add_to_bucket(index, self.availability[index])
+        self._first_missing = min(self._first_missing, index)
+
+    def pick(self, has_piece) -> Iterator[int]:
+        """
+        Yield the indices of the pieces worth requesting from a peer,
+        has_piece tells if the peer have the given piece index.
+        In rarest first mode, the pieces already started are yielded
+        first so they complete quickly, and then the fresh pieces from
+        the rarest to the most common, with random order between pieces
+        of the same availability, each bucket from a random position.
+        In sequential mode the pieces
+        are simply yielded by their index.
+        """
+        if self.sequential:
+            for index in range(self._first_missing, self.number_of_pieces):
+                if index not in self.completed and has_piece(index):
+                    yield index
+            return
+
+        for index in sorted(self.started, key=self.availability.__getitem__):
+            if has_piece(index):
+                yield index
+
+        for availability in sorted(self.buckets):
+            for index in random_rotation(self.buckets.get(availability, [])):
+                # The buckets may change while we iterate
+                if self._is_fresh(index) and has_piece(index):
+                    yield index
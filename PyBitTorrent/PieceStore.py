@@ -0,0 +1,181 @@
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+from PyBitTorrent.Block import Block, BlockStatus
+from PyBitTorrent.Exceptions import NoPieceFound, PieceIsPending
+from PyBitTorrent.Piece import Piece
+
+
+class PieceStore:
+    def __init__(self, file_size, piece_size):
+        """
+        Keep the state of all the pieces in a compact form:
+        one byte per piece says if it is completed, and Piece
+        objects are created only for the pieces in flight.
+        The blocks counters are kept up to date on every status
+        change, so the download loop never has to scan the pieces.
+        """
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.number_of_pieces = -(-file_size // piece_size)
+        self.completed = bytearray(self.number_of_pieces)
+        self.completed_pieces = 0
+        self.completed_bytes = 0
+        self.active: Dict[int, Piece] = {}
+
+        blocks_per_piece = -(-piece_size // Block.default_size)
+        last_piece_blocks = -(-self.get_piece_size(self.number_of_pieces - 1) // Block.default_size)
+        self.free_blocks = blocks_per_piece * (self.number_of_pieces - 1) + last_piece_blocks
+        self.requested_blocks = 0
+        self.full_blocks = 0
+
+        # The blocks peers are receiving straight into their pieces, to the peer and the pin time
+        self._pinned: Dict[Tuple[int, int], Tuple[object, float]] = {}
+
+    def __iter__(self) -> Iterator[Piece]:
+        """
+        Iterate over the pieces in flight
+        """
+        return iter(list(self.active.values()))
+
+    def is_complete(self) -> bool:
+        return self.completed_pieces == self.number_of_pieces
+
+    @property
+    def left(self) -> int:
+        """
+        Bytes of the pieces not completed yet, as reported to the trackers
+        """
+        return self.file_size - self.completed_bytes
+
+    def get_piece_size(self, index):
+        if index == self.number_of_pieces - 1:
+            return self.file_size - self.piece_size * index
+
+        return self.piece_size
+
+    def get_piece(self, index) -> Piece:
+        """
+        Return the piece in the given index, the piece
+        object is created the first time it is needed
+        """
+        try:
+            return self.active[index]
+        except KeyError:
+            pass
+
+        if not 0 <= index < self.number_of_pieces or self.completed[index]:
+            raise NoPieceFound
+
+        piece = Piece(index, self.get_piece_size(index))
+        self.active[index] = piece
+        return piece
+
+    def get_block(self, index, offset) -> Tuple[Piece, Block]:
+        piece = self.get_piece(index)
+        return piece, piece.get_block_by_offset(offset)
+
+    def set_requested(self, piece: Piece, block: Block, peer=None):
+        if block.status == BlockStatus.FREE:
+            self.free_blocks -= 1
+            self.requested_blocks += 1
+            piece.free_blocks -= 1
+
+        block.set_requested()
+        piece.owners[block.position] = peer
+
+    def set_free(self, piece: Piece, block: Block):
+        if block.status != BlockStatus.REQUESTED:
+            return
+
+        block.status = BlockStatus.FREE
+        piece.owners[block.position] = None
+        self.requested_blocks -= 1
+        self.free_blocks += 1
+        piece.free_blocks += 1
+
+    def set_full(self, piece: Piece, block: Block, data, peer=None):
+        if block.status == BlockStatus.REQUESTED:
+            self.requested_blocks -= 1
+        elif block.status == BlockStatus.FREE:
+            self.free_blocks -= 1
+            piece.free_blocks -= 1
+        else:
+            return
+
+        piece.set_block_data(block, data)
+        piece.owners[block.position] = peer  # From now on, the peer that sent it
+        block.status = BlockStatus.FULL
+        self.full_blocks += 1
+        piece.full_blocks += 1
+
+    def pin_block(self, peer, index, offset, length) -> Optional[memoryview]:
+        """
+        Pin a block that is not full for the peer to receive it straight
+        into its piece, and return the memory of the block. No other copy
+        of a pinned block is taken, so the piece can't be completed and
+        verified while the peer writes into it. None if it can't be pinned.
+        """
+        try:
+            piece, block = self.get_block(index, offset)
+        except (NoPieceFound, PieceIsPending):
+            return None
+
+        key = (index, block.position)
+        if block.status == BlockStatus.FULL or length != block.size or key in self._pinned:
+            return None
+
+        self._pinned[key] = (peer, time.time())
+        return piece.get_block_buffer(block)
+
+    def pinned_by(self, piece: Piece, block: Block) -> Tuple[object, float]:
+        """
+        The peer receiving the block into its piece and since when, None and 0 if none is
+        """
+        return self._pinned.get((piece.index, block.position), (None, 0.0))
+
+    def unpin_block(self, piece: Piece, block: Block):
+        self._pinned.pop((piece.index, block.position), None)
+
+    def unpin_blocks(self, peer):
+        """
+        Unpin the blocks of a removed peer, what it received of them is dropped
+        """
+        for key in [key for key, (pinned_by, _) in self._pinned.items() if pinned_by is peer]:
+            del self._pinned[key]
+
+    def piece_completed(self, piece: Piece):
+        """
+        Forget the piece after it was written
+        """
+        del self.active[piece.index]
+        self.completed[piece.index] = 1
+        self.completed_pieces += 1
+        self.completed_bytes += piece.size
+
+    def set_completed(self, index):
+        """
+        Mark a piece that was never active as completed,
+        used for the pieces found on the disk when resuming
+        """
+        if self.completed[index] or index in self.active:
+            return
+
+        blocks = -(-self.get_piece_size(index) // Block.default_size)
+        self.free_blocks -= blocks
+        self.full_blocks += blocks
+        self.completed[index] = 1
+        self.completed_pieces += 1
+        self.completed_bytes += self.get_piece_size(index)
+
+    def reset_piece(self, piece: Piece):
+        """
+        Forget all the blocks of the piece, a
+        new piece object will be created when needed
+        """
+        for block in piece.blocks:
+            self.set_free(piece, block)
+
+        self.full_blocks -= piece.full_blocks
+        self.free_blocks += piece.full_blocks
+        del self.active[piece.index]
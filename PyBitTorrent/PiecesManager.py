@@ -1,61 +1,281 @@
+import bisect
 import logging
+import mmap
 import os
-import tempfile
+import time
+from typing import Iterator, List, Set, Tuple, Union
+
 from PyBitTorrent import TorrentFile
+from PyBitTorrent.Configuration import CONFIGURATION
+
+# Max buffers in a single vectored write
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def pwrite(fd, data: memoryview, offset):
+    """
+    Write all the data in the given offset of the file,
+    without moving the file position
+    """
+    while data:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+
+        data = data[written:]
+        offset += written
+
+
+def pwritev(fd, buffers: List[memoryview], offset):
+    """
+    Write all the buffers one after the other in the given
+    offset of the file, with as few syscalls as possible
+    """
+    buffers = [buffer for buffer in buffers if buffer]
+    while buffers:
+        batch = buffers[:IOV_MAX]
+        written = os.pwritev(fd, batch, offset)
+        offset += written
+
+        # Skip the buffers that were fully written, and cut the partly written one
+        while written and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+def pread(fd, length, offset) -> bytearray:
+    data = bytearray(length)
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "preadv"):
+            read = os.preadv(fd, [view], offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            chunk = os.read(fd, len(view))
+            read = len(chunk)
+            view[:read] = chunk
+
+        if not read:
+            break  # The file is shorter, the rest stays zeros
+
+        view = view[read:]
+        offset += read
+
+    return data
+
+
+class TargetFile:
+    def __init__(self, path: str, offset: int, length: int, use_mmap: bool = False):
+        """
+        A file of the torrent, and the offset
+        of its first byte in the torrent data.
+        When use_mmap is set, the file is preallocated and mapped,
+        and all the writes and reads go through the mapping.
+        """
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.map = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)  # Create directories if necessary
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+        # The state of the file from a previous run, used to decide if the resume data is valid
+        stat = os.fstat(self.fd)
+        self.existing_size = stat.st_size
+        self.existing_mtime = stat.st_mtime_ns
+        # Keep the existing data, only set the final size
+        if self.existing_size != length:
+            os.ftruncate(self.fd, length)
+
+        if use_mmap and length:
+            self.map = mmap.mmap(self.fd, length)
+
+        # File object over the same descriptor, used to send the data with sendfile
+        self.file = open(self.fd, "rb", buffering=0, closefd=False)
+
+    def write(self, buffers: List[memoryview], offset):
+        """
+        Write the buffers one after the other from the given offset,
+        as one vectored write when the platform supports it
+        """
+        if self.map is None and hasattr(os, "pwritev"):
+            pwritev(self.fd, buffers, offset)
+            return
+
+        for data in buffers:
+            if self.map is not None:
+                self.map[offset:offset + len(data)] = data
+            else:
+                pwrite(self.fd, data, offset)
+
+            offset += len(data)
+
+    def read(self, length, offset):
+        """
+        Read from the file, with mmap this is a zero copy slice of the mapping
+        """
+        if self.map is not None:
+            return memoryview(self.map)[offset:offset + length]
+
+        return pread(self.fd, length, offset)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Slices returned by read are still used, unmapped when released
+
+        self.file.close()
+        os.close(self.fd)
 
 
 class DiskManager:
-    def __init__(self, output_directory: str, torrent: TorrentFile):
+    def __init__(self, output_directory: str, torrent: TorrentFile, use_mmap: bool = CONFIGURATION.use_mmap):
         self.output_directory = output_directory
         self.torrent = torrent
         self.written = 0
+        self.use_mmap = use_mmap
+        # In mmap mode the kernel writes back the pages, msync is only forced by the flush policy
+        self._dirty_files: Set[TargetFile] = set()
+        self._dirty_bytes = 0
+        self._last_flush = time.time()
         self.multi_part = "files" in self.torrent.info.keys()
         logging.getLogger("BitTorrent").debug(f"DiskManager output directory is {output_directory}")
 
         # Ensure output directory exists
         os.makedirs(output_directory, exist_ok=True)
 
+        self.files: List[TargetFile] = []
         if self.multi_part:
-            self.file = tempfile.TemporaryFile()
+            offset = 0
+            for file in self.torrent.info['files']:
+                # Calculate the full path of each file including the output_directory
+                file_path = os.path.join(self.output_directory, self.torrent.file_name, *file['path'])
+                self.files.append(TargetFile(file_path, offset, file['length'], use_mmap))
+                offset += file['length']
         else:
             # Update to use output_directory for single file torrent
             file_path = os.path.join(output_directory, self.torrent.file_name)
-            self.file = open(file_path, "wb")
+            self.files.append(TargetFile(file_path, 0, self.torrent.length, use_mmap))
+
+        self._offsets = [file.offset for file in self.files]
 
-    def write_piece(self, piece, piece_size):
+    def _map(self, offset, length) -> Iterator[Tuple[TargetFile, int, int, int]]:
         """
-        Write piece to disk according to the offset
+        Map a range of the torrent data onto the files it is stored in.
+        Yield each file with the offset in the file, and the start and
+        end of the part of the range stored in it.
         """
-        piece_data = piece.get_data()
-        self.file.seek(piece_size * piece.index)
-        self.file.write(piece_data)
-        self.file.flush()
+        position = bisect.bisect_right(self._offsets, offset) - 1
+        start = 0
+        while start < length and position < len(self.files):
+            file = self.files[position]
+            file_offset = offset + start - file.offset
+            end = min(length, start + file.length - file_offset)
+            if end > start:
+                yield file, file_offset, start, end
+                start = end
 
-        self.written += 1
+            position += 1
 
-    def close(self):
+    def write(self, offset, buffers: List[memoryview]):
         """
-        Reorganize the pieces according to the
-        Files structure specified in the torent file
+        Write buffers that are consecutive in the torrent data from
+        the given offset. Each file gets all its part in one write.
         """
-        # If torrent contain multiple file, split them
-        if self.multi_part:
-            self.file.seek(0)
-            for file in self.torrent.info['files']:
-                # Calculate the full path of each file including the output_directory
-                file_path = os.path.join(self.output_directory, self.torrent.file_name)
-                for entity in file['path']:
-                    file_path = os.path.join(file_path, entity)
+        length = sum(len(buffer) for buffer in buffers)
+        buffers = iter(buffers)
+        buffer = next(buffers)
+        for file, file_offset, start, end in self._map(offset, length):
+            # Collect the parts of the buffers that belong to this file
+            parts = []
+            size = end - start
+            while size:
+                if not buffer:
+                    buffer = next(buffers)
+                    continue
 
-                logging.getLogger("BitTorrent").debug(f"Def close file path is {file_path}")
-                logging.getLogger("BitTorrent").debug(f"Diskmanager output directory is {file_path}")
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Create directories if necessary
-                logging.getLogger("BitTorrent").debug(f"Writing data in offsets {self.file.tell()}:{file['length']}")
+                part, buffer = buffer[:size], buffer[size:]
+                parts.append(part)
+                size -= len(part)
 
-                # Create the file and copy the data
-                f = open(file_path, 'wb')
-                file_data = self.file.read(file['length'])
-                f.write(file_data)
-                f.close()
+            file.write(parts, file_offset)
+            if file.map is not None:
+                self._dirty_files.add(file)
 
-        self.file.close()
+        self._dirty_bytes += length
+        self._flush_if_needed()
+
+    def read(self, offset, length):
+        """
+        Read a range of the torrent data. With mmap, a range
+        inside a single file is a zero copy slice of the mapping.
+        """
+        parts = [
+            file.read(end - start, file_offset)
+            for file, file_offset, start, end in self._map(offset, length)
+        ]
+        if len(parts) == 1:
+            return parts[0]
+
+        return b"".join(parts)
+
+    def sources(self, offset, length) -> List[Union[memoryview, Tuple]]:
+        """
+        Where to send a range of the torrent data from without copying
+        it: slices of the mappings in mmap mode, otherwise the file
+        objects with the offset and size of each part for sendfile
+        """
+        return [
+            file.read(end - start, file_offset) if file.map is not None else (file.file, file_offset, end - start)
+            for file, file_offset, start, end in self._map(offset, length)
+        ]
+
+    def has_existing_data(self, offset, length) -> bool:
+        """
+        Check if a range of the torrent data was
+        in the files before they were opened
+        """
+        return any(
+            file_offset < file.existing_size
+            for file, file_offset, start, end in self._map(offset, length)
+        )
+
+    def _flush_if_needed(self):
+        """
+        Schedule msync by size and age of the dirty data,
+        instead of forcing it after every piece
+        """
+        if not self._dirty_files:
+            return
+
+        if (
+            self._dirty_bytes >= CONFIGURATION.mmap_flush_size
+            or time.time() - self._last_flush >= CONFIGURATION.mmap_flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        for file in self._dirty_files:
+            file.flush()
+
+        self._dirty_files.clear()
+        self._dirty_bytes = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        for file in self.files:
+            file.close()
@@ -0,0 +1,92 @@
+import logging
+import os
+from typing import Dict, Optional
+
+from PyBitTorrent.bcoder import bencode, bdecode
+from PyBitTorrent.Exceptions import UnexpectedResponse
+from PyBitTorrent.PiecesManager import DiskManager
+from PyBitTorrent.TorrentFile import TorrentFile
+
+
+def _to_bytes(value) -> bytes:
+    # bdecode returns the strings it could decode as str
+    return value.encode() if isinstance(value, str) else value
+
+
+class ResumeData:
+    def __init__(self, output_directory: str, torrent: TorrentFile, disk_manager: DiskManager):
+        """
+        The fast resume file, saved next to the output. It keeps one
+        byte per piece telling if the piece is written on the disk,
+        the size and modification time of every file when it was
+        saved, and the blocks of the pieces that were not completed.
+        """
+        self.path = os.path.join(output_directory, f"{torrent.file_name}.resume")
+        self.torrent = torrent
+        self.disk_manager = disk_manager
+        self.number_of_pieces = -(-torrent.length // torrent.piece_size)
+        self.written = bytearray(self.number_of_pieces)
+
+    def load(self) -> Optional[Dict]:
+        """
+        Return the saved resume data, if it belongs to this torrent and
+        the files were not changed since it was saved, otherwise None
+        """
+        try:
+            with open(self.path, "rb") as resume_file:
+                resume = bdecode(resume_file.read())
+
+            return self._validate(resume)
+        except (OSError, UnexpectedResponse, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _validate(self, resume) -> Optional[Dict]:
+        if not isinstance(resume, dict) or resume.get("info hash") != self.torrent.hash.hex():
+            return None
+
+        files = resume.get("files", [])
+        if len(files) != len(self.disk_manager.files):
+            return None
+
+        for saved, file in zip(files, self.disk_manager.files):
+            if saved["length"] != file.existing_size or saved["mtime"] != file.existing_mtime:
+                logging.getLogger("BitTorrent").info(f"{file.path} was changed since the resume data was saved")
+                return None
+
+        pieces = _to_bytes(resume["pieces"])
+        if len(pieces) != self.number_of_pieces:
+            return None
+
+        self.written[:] = pieces
+        resume["pieces"] = pieces
+        resume["partial"] = {
+            int(index): _to_bytes(blocks) for index, blocks in resume.get("partial", {}).items()
+        }
+        return resume
+
+    def pieces_written(self, indices):
+        for index in indices:
+            self.written[index] = 1
+
+    def save(self, partial: Dict[int, bytes] = None):
+        """
+        Save the resume data, partial maps a piece index to the blocks of
+        it that are already on the disk. The file is replaced atomically,
+        so an interrupted save leaves the previous resume data.
+        """
+        self.disk_manager.flush()
+        resume = {
+            "info hash": self.torrent.hash.hex(),
+            "pieces": bytes(self.written),
+            "files": [
+                {"length": os.fstat(file.fd).st_size, "mtime": os.fstat(file.fd).st_mtime_ns}
+                for file in self.disk_manager.files
+            ],
+            "partial": {str(index): blocks for index, blocks in (partial or {}).items()},
+        }
+
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "wb") as resume_file:
+            resume_file.write(bencode(resume))
+
+        os.replace(temporary_path, self.path)
@@ -1,10 +1,10 @@
 import hashlib
 import logging
-from copy import deepcopy
+from typing import Dict
 
 import rich
-from PyBitTorrent.bcoder import bencode, bdecode
-from PyBitTorrent.Exceptions import KeyNotFound
+from PyBitTorrent.bcoder import bdecode, bdecode_spans
+from PyBitTorrent.Exceptions import KeyNotFound, UnexpectedResponse
 
 
 class TorrentFile:
@@ -15,45 +15,97 @@ class TorrentFile:
         and then calculate the sha1 value of the info dict.
         this important value will later use us in peer retrieve
         process and in the handshakes process.
+        Only the places of the values are found when loading, the
+        info hash is taken over the original bytes of the info dict,
+        and the other values are decoded when they are first used.
         """
         logging.getLogger("BitTorrent").info("Start reading from BitTorrent file")
         with open(torrent, 'rb') as torrent_file:
-            torrent_data = torrent_file.read()
+            self.raw: bytes = torrent_file.read()
 
-        self.config = bdecode(torrent_data)
-        self.info = self.config["info"]
-        self.hash = hashlib.sha1(bencode(self.info)).digest()
-        self.length = 0
-        self.print_configuration()
+        # The spans of the info dict are found while walking over it
+        nested = {"info": None}
+        self._spans = bdecode_spans(self.raw, nested=nested)
+        if "info" not in self._spans:
+            raise KeyNotFound
+
+        info_start, info_end = self._spans["info"]
+        self._info_spans = nested["info"]
+        self.hash = hashlib.sha1(memoryview(self.raw)[info_start:info_end]).digest()
+        self._config: Dict = None
+        self._info: Dict = None
+
+        # The SHA1 values of all the pieces, concatenated, as a view of the file data
+        if "pieces" not in self._info_spans:
+            raise KeyNotFound
 
-        for key in [["name", "file_name"], ["piece length", "piece_size"]]:
-            self._set_attribute_from_info(*key)
+        pieces_start, pieces_end = self._info_spans["pieces"]
+        colon = self.raw.find(b":", pieces_start, pieces_end)
+        if colon == -1:
+            raise UnexpectedResponse
 
-        # Calculate the total length
-        if "files" in self.info.keys():
-            for file in self.info["files"]:
-                self.length += file["length"]
+        self.pieces_hashes: memoryview = memoryview(self.raw)[colon + 1:pieces_end]
+
+        self.file_name = self._get("name")
+        self.piece_size = self._get("piece length")
+        # Calculate the total length, only the files list is decoded, its paths stay bytes
+        if "files" in self._info_spans:
+            files_start, _ = self._info_spans["files"]
+            files = bdecode(self.raw, decode_strings=False, index=files_start)
+            self.length = sum(file["length"] for file in files)
         else:
-            self._set_attribute_from_info("length", "length")
+            self.length = self._get("length")
+
+    def _decode(self, span):
+        start, _ = span
+        return bdecode(self.raw, index=start)
+
+    def _get(self, key):
+        """
+        Decode a value of the info dict if exists
+        else get the value from config
+        """
+        if key in self._info_spans:
+            return self._decode(self._info_spans[key])
+        elif key in self._spans:
+            return self._decode(self._spans[key])
+        else:
+            raise KeyNotFound
+
+    @property
+    def info(self) -> Dict:
+        """
+        The info dict, decoded on the first use. The
+        pieces in it are the view of the hashes.
+        """
+        if self._info is None:
+            self._info = {
+                key: self._decode(span) for key, span in self._info_spans.items() if key != "pieces"
+            }
+            self._info["pieces"] = self.pieces_hashes
+
+        return self._info
+
+    @property
+    def config(self) -> Dict:
+        """
+        The whole metainfo, decoded on the first use
+        """
+        if self._config is None:
+            self._config = {key: self._decode(span) for key, span in self._spans.items() if key != "info"}
+            self._config["info"] = self.info
+
+        return self._config
 
     def print_configuration(self):
         """
         Help function for printing the configuration of
         the torrent file in an nice-to-look way using rich.
         """
-        config = deepcopy(self.config)
-
-        config["info"]["pieces"] = ""
+        config = dict(self.config)
+        config["info"] = dict(self.info)
+        config["info"]["pieces"] = f"<{len(self.pieces_hashes) // 20} pieces>"
         rich.print(config)
 
-    def _set_attribute_from_info(self, key, self_key) :
-        """
-        Set value from info dict to self if exists
-        else get the value from config
-        """
-        if key in self.info.keys() :
-            self.__dict__[self_key] = self.info[key]
-        elif key in self.config.keys() :
-            self.__dict__[self_key] = self.config[key]
-        else :
-            raise KeyNotFound
+    def get_piece_hash(self, index) -> memoryview:
+        return self.pieces_hashes[index * 20:(index + 1) * 20]
@@ -1,7 +1,10 @@
+import asyncio
+import functools
 import socket
 import struct
 from abc import ABC, abstractmethod
-from typing import List
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
 
 from PyBitTorrent.Peer import Peer
 from PyBitTorrent.TorrentFile import TorrentFile
@@ -11,9 +14,63 @@ from PyBitTorrent.Configuration import CONFIGURATION
 class Tracker(ABC):
     def __init__(self, url):
         self.url = url
+        # Seconds between announces the tracker asked for, in its last answer
+        self.interval: Optional[int] = None
+        self.min_interval: Optional[int] = None
+        # The swarm as the tracker last reported it, and the seconds its last answer took
+        self.seeders: Optional[int] = None
+        self.leechers: Optional[int] = None
+        self.latency: Optional[float] = None
+
+    def __str__(self):
+        return self.url
 
     @abstractmethod
-    def get_peers(self, peer_id: bytes, port: int, torrent: TorrentFile) -> List[Peer]:
+    def get_peers(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "started",
+    ) -> Optional[List[Peer]]:
+        """
+        Announce to the tracker and return the peers it sent, None when it failed. uploaded, downloaded
+        and left are our statistics in bytes (left defaults to the torrent length),
+        event is one of "started", "completed", "stopped", or "" for the regular ones.
+        """
+        pass
+
+    async def announce(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "started",
+        executor: Executor = None,
+    ) -> Optional[List[Peer]]:
+        """
+        Get the peers without blocking the event loop,
+        by default get_peers runs in the given executor
+        """
+        loop = asyncio.get_running_loop()
+        get_peers = functools.partial(
+            self.get_peers, peer_id, port, torrent,
+            uploaded=uploaded, downloaded=downloaded, left=left, event=event,
+        )
+        return await loop.run_in_executor(executor, get_peers)
+
+    def get_scrape(self, torrent: TorrentFile) -> Optional[Dict[str, int]]:
+        """
+        Return the numbers of seeders (complete), leechers (incomplete) and
+        completed downloads (downloaded) of the torrent, None when unknown
+        """
+        return None
+
+    async def scrape(self, torrent: TorrentFile, executor: Executor = None) -> Optional[Dict[str, int]]:
+        """
+        Scrape without blocking the event loop, like announce
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.get_scrape, torrent)
+
+    def close(self):
+        """
+        Release what the tracker holds, when the client stops
+        """
         pass
 
     @staticmethod
@@ -23,6 +80,9 @@ class Tracker(ABC):
         if not peers_bytes:
             return []
 
+        if isinstance(peers_bytes, str):
+            peers_bytes = peers_bytes.encode()  # bdecode returns the strings it could decode as str
+
         for _ in range(len(peers_bytes) // CONFIGURATION.compact_value_num_bytes):
             ip, port = struct.unpack_from("!iH", peers_bytes, offset)
             ip = socket.inet_ntoa(struct.pack("!i", ip))
@@ -1,3 +1,5 @@
+import logging
+import random
 from typing import List
 from urllib.parse import urlparse
 
@@ -30,11 +32,33 @@ class TrackerFactory:
     def create_trackers(urls: List[str]) -> List[Tracker]:
         """
         Create trackers from the given url list.
-        Current options are HTTP/UDP.
+        Current options are HTTP/UDP, other
+        trackers and the disabled UDP trackers are skipped.
         """
         trackers = []
         for url in urls:
-            tracker = TrackerFactory.create_tracker(url[0])
-            trackers.append(tracker)
+            try:
+                tracker = TrackerFactory.create_tracker(url)
+            except UnknownTracker:
+                logging.getLogger("BitTorrent").info(f"Skipping unsupported tracker {url}")
+                continue
+
+            if tracker:
+                trackers.append(tracker)
 
         return trackers
+
+    @staticmethod
+    def create_tiers(announce_list: List[List[str]]) -> List[List[Tracker]]:
+        """
+        Create the tiers of trackers of the announce-list (BEP 12),
+        the trackers of each tier are shuffled, and empty tiers dropped
+        """
+        tiers = []
+        for urls in announce_list:
+            tier = TrackerFactory.create_trackers(urls)
+            random.shuffle(tier)
+            if tier:
+                tiers.append(tier)
+
+        return tiers
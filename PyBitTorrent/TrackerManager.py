@@ -1,25 +1,214 @@
-from typing import List
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
 from PyBitTorrent.Peer import Peer
 from PyBitTorrent.TorrentFile import TorrentFile
 from PyBitTorrent.Tracker import Tracker
+from PyBitTorrent.Configuration import CONFIGURATION
+
+# Seconds to wait for a tracker before trying the next tracker of its tier too
+TRACKER_FALLBACK_DELAY = 1.0
+
+# Seconds between announces, when the tracker didn't say
+DEFAULT_INTERVAL = 1800
+DEFAULT_MIN_INTERVAL = 60
+
+# Seconds before announcing again to a tier that failed
+FAILED_TIER_RETRY = 60
 
 
 class TrackerManager:
-    def __init__(self, trackers: List[Tracker]):
-        self.trackers: List[Tracker] = trackers
+    def __init__(self, tiers: List[List[Tracker]]):
+        """
+        The trackers, grouped in tiers as in the announce-list (BEP 12).
+        The tiers are announced to at the same time, and inside each
+        tier the trackers are tried by their order until one answers.
+        """
+        self.tiers: List[List[Tracker]] = tiers
+        self.trackers: List[Tracker] = [tracker for tier in tiers for tracker in tier]
+        # When each tier should be announced to again, and the earliest time it may be when more peers are needed
+        self._next_announce = [0.0] * len(tiers)
+        self._min_next_announce = [0.0] * len(tiers)
+        # The tiers that got the started event
+        self._started = [False] * len(tiers)
+        # The trackers that do blocking IO run here, so a dead tracker doesn't hold the others
+        self._pool = ThreadPoolExecutor(max(2 * len(self.trackers), 1))
 
-    def get_peers(
-        self, peer_id: bytes, port: int, torrent_file: TorrentFile
-    ) -> List[Peer]:
+    async def rank(self, torrent: TorrentFile, deadline: float = TRACKER_FALLBACK_DELAY):
         """
-        Return list of peers, by calling each tracker 'get_peer' method.
-        This will cause a series of HTTP/UDP requests, in the end each
-        one will return his list of peers.
+        Scrape the trackers of the tiers that have more than one, and order
+        each of these tiers by the size of the swarm its trackers report,
+        the fastest to answer first between equal swarms. The trackers
+        that didn't answer within the deadline keep their order, last.
         """
-        peers = []
-        for tracker in self.trackers:
-            tracker_peers = tracker.get_peers(peer_id, port, torrent_file)
-            peers += tracker_peers
+        trackers = [tracker for tier in self.tiers if len(tier) > 1 for tracker in tier]
+        if not trackers:
+            return
+
+        scrapes = [asyncio.ensure_future(self._scrape_tracker(tracker, torrent)) for tracker in trackers]
+        _, pending = await asyncio.wait(scrapes, timeout=deadline)
+        for scrape in pending:
+            scrape.cancel()
+
+        for tier in self.tiers:
+            tier.sort(key=self._rank)
+
+    @staticmethod
+    def _rank(tracker: Tracker):
+        if tracker.latency is None:
+            return 1, 0, 0
+
+        return 0, -((tracker.seeders or 0) + (tracker.leechers or 0)), tracker.latency
+
+    async def _scrape_tracker(self, tracker: Tracker, torrent: TorrentFile):
+        start = time.time()
+        try:
+            stats = await tracker.scrape(torrent, executor=self._pool)
+        except Exception as e:
+            logging.getLogger("BitTorrent").debug(f"Scraping tracker {tracker} failed: {e!r}")
+            return
+
+        if stats:
+            tracker.latency = time.time() - start
+            tracker.seeders = stats.get("complete", tracker.seeders)
+            tracker.leechers = stats.get("incomplete", tracker.leechers)
+            logging.getLogger("BitTorrent").debug(
+                f"Tracker {tracker} has {tracker.seeders} seeders and {tracker.leechers} leechers"
+            )
+
+    def due_tiers(self, need_peers: bool = False) -> List[int]:
+        """
+        The tiers to announce to now: the ones whose interval passed,
+        and when more peers are needed, the ones whose min interval passed
+        """
+        now = time.time()
+        return [
+            index for index in range(len(self.tiers))
+            if now >= self._next_announce[index] or (need_peers and now >= self._min_next_announce[index])
+        ]
+
+    def time_to_next_announce(self, need_peers: bool = False) -> float:
+        """
+        Seconds until a tier should be announced to
+        """
+        schedule = self._min_next_announce if need_peers else self._next_announce
+        return min(schedule, default=float("inf")) - time.time()
+
+    async def announce(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        on_peers: Callable[[List[Peer]], None],
+        deadline: float = CONFIGURATION.announce_deadline,
+        tiers: List[int] = None,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "",
+    ) -> int:
+        """
+        Announce to the given tiers (all by default) at the same time, and pass
+        the peers of each tracker to on_peers as soon as it answers. Stop waiting
+        for the trackers after the deadline, return the number of peers found.
+        A tier that was never announced to gets the started event instead,
+        and only the tiers that got it are told that we stopped.
+        """
+        if tiers is None:
+            tiers = range(len(self.tiers))
+        if event == "stopped":
+            tiers = [index for index in tiers if self._started[index]]
+
+        start = time.time()
+        stats = {"uploaded": uploaded, "downloaded": downloaded, "left": left}
+        announces = [
+            asyncio.ensure_future(self._announce_tier(
+                index, peer_id, port, torrent, on_peers, start,
+                event=event if self._started[index] else "started", **stats
+            ))
+            for index in tiers
+        ]
+        if not announces:
+            return 0
+
+        done, pending = await asyncio.wait(announces, timeout=deadline)
+        for announce in pending:
+            announce.cancel()
+
+        if pending:
+            logging.getLogger("BitTorrent").info(
+                f"{len(pending)}/{len(announces)} tiers did not answer within {deadline} seconds"
+            )
+
+        return sum(announce.result() for announce in done)
+
+    async def _announce_tier(self, index: int, peer_id, port, torrent, on_peers, start, **stats) -> int:
+        """
+        Announce to the trackers of the tier by their order. The next tracker
+        starts when the previous ones failed or didn't answer for a while, and
+        the first tracker that answers moves to the front of the tier.
+        """
+        tier = self.tiers[index]
+        # Until a tracker answers, the tier is tried again later
+        self._next_announce[index] = self._min_next_announce[index] = time.time() + FAILED_TIER_RETRY
+        attempts: Dict[asyncio.Future, Tracker] = {}
+        trackers = iter(list(tier))
+        try:
+            while True:
+                tracker = next(trackers, None)
+                if tracker is not None:
+                    attempt = asyncio.ensure_future(self._announce_tracker(tracker, peer_id, port, torrent, **stats))
+                    attempts[attempt] = tracker
+                elif not attempts:
+                    return 0
+
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=TRACKER_FALLBACK_DELAY if tracker is not None else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for attempt in done:
+                    tracker = attempts.pop(attempt)
+                    peers = attempt.result()
+                    # An answer without peers is still an answer, the tier is announced again on schedule
+                    if peers is None:
+                        continue
+
+                    tier.remove(tracker)
+                    tier.insert(0, tracker)
+                    self._schedule(index, tracker)
+                    self._started[index] = stats["event"] != "stopped"
+                    logging.getLogger("BitTorrent").info(
+                        f"Tracker {tracker} answered with {len(peers)} peers after {time.time() - start:.2f} seconds"
+                    )
+                    on_peers(peers)
+                    return len(peers)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def _schedule(self, index: int, tracker: Tracker):
+        now = time.time()
+        interval = tracker.interval or DEFAULT_INTERVAL
+        min_interval = min(tracker.min_interval or DEFAULT_MIN_INTERVAL, interval)
+        self._next_announce[index] = now + interval
+        self._min_next_announce[index] = now + min_interval
+
+    async def _announce_tracker(self, tracker: Tracker, peer_id, port, torrent, **stats) -> Optional[List[Peer]]:
+        start = time.time()
+        try:
+            peers = await tracker.announce(peer_id, port, torrent, executor=self._pool, **stats)
+        except Exception as e:
+            # A broken tracker must not stop the announces to the others
+            logging.getLogger("BitTorrent").error(f"Tracker {tracker} failed: {e!r}")
+            return None
+
+        if peers is not None:
+            tracker.latency = time.time() - start
 
         return peers
+
+    def close(self):
+        for tracker in self.trackers:
+            tracker.close()
+
+        # Every tracker has a worker for its announce and its scrape, so no call waits
+        # in the queue, and the calls in flight can't be stopped but end by their timeout
+        self._pool.shutdown(wait=False)
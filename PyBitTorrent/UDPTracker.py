@@ -1,68 +1,93 @@
+import asyncio
 import logging
-import socket
-from typing import List
+import struct
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
 from urllib.parse import urlparse
 
+from PyBitTorrent.Configuration import CONFIGURATION
+from PyBitTorrent.Exceptions import TrackerError
 from PyBitTorrent.Peer import Peer
 from PyBitTorrent.TorrentFile import TorrentFile
 from PyBitTorrent.Tracker import Tracker
-from PyBitTorrent.UDPTrackerMessage import Connection, Announce, AnnounceResult
-from PyBitTorrent.Configuration import CONFIGURATION
+from PyBitTorrent.UDPTrackerClient import UDPTrackerClient
+from PyBitTorrent.UDPTrackerMessage import Announce, AnnounceResult, Scrape, ScrapeResult
 
 
 class UDPTracker(Tracker):
+    def __init__(self, url):
+        super().__init__(url)
+        url_details = urlparse(url)
+        self.address = (url_details.hostname, url_details.port)
 
-    def get_peers(self, peer_id: bytes, port: int, torrent: TorrentFile) -> List[Peer]:
+    def get_peers(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "started",
+    ) -> Optional[List[Peer]]:
+        """
+        Blocking version of announce, for callers without an event loop
         """
-        Connect to udp tracker and retrieve from him list of peers. Following the
+        async def announce():
+            try:
+                return await self.announce(
+                    peer_id, port, torrent, uploaded=uploaded, downloaded=downloaded, left=left, event=event
+                )
+            finally:
+                self.close()
+
+        return asyncio.run(announce())
+
+    async def announce(
+        self, peer_id: bytes, port: int, torrent: TorrentFile,
+        uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = "started",
+        executor: Executor = None,
+    ) -> Optional[List[Peer]]:
+        """
+        Connect to udp tracker and retrieve from him list of peers, None when it failed. Following the
         BitTorrent UDP Tracker specification, And sourceforge unofficial guide:
         https://www.bittorrent.org/beps/bep_0015.html
         https://xbtt.sourceforge.net/udp_tracker_protocol.html
+        The socket never blocks, so no executor is needed.
         """
-        connection_id = 0x41727101980
-        url_details = urlparse(self.url)
-        tracker_address = (url_details.hostname, url_details.port)
-        connection_request = Connection()
-
+        announce = Announce(
+            0, torrent.hash, peer_id, torrent.length if left is None else left, port,
+            uploaded=uploaded, downloaded=downloaded, event=event, num_want=CONFIGURATION.numwant,
+        )
         try:
-            # Send Connection Request
-            sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-            sock.sendto(connection_request.to_bytes(), tracker_address)
-
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.settimeout(CONFIGURATION.timeout)
+            client = await UDPTrackerClient.get_client()
+            response = AnnounceResult.from_bytes(await client.request(self.address, announce))
+        except (TrackerError, OSError, struct.error) as e:
+            logging.getLogger("BitTorrent").error(f"Tracker {self.url} give no answer: {e}")
+            return None
 
-            response = sock.recv(CONFIGURATION.udp_tracker_receive_size)  # Answer should be 16 bytes
+        self.interval = response.interval or self.interval
+        self.seeders, self.leechers = response.seeders, response.leechers
+        peers = Tracker.extract_compact_peers(response.peers)
+        logging.getLogger("BitTorrent").info(
+            f"success in scraping {self.url} got {len(peers)} peers"
+        )
+        return peers
 
-            connection_response = Connection.from_bytes(response)
-            connection_id = connection_response.connection_id
-
-            if connection_request != connection_response:
-                logging.getLogger("BitTorrent").error(
-                    "UDP Tracker request and response are not equal"
-                )
-
-            announce = Announce(
-                connection_id, torrent.hash, peer_id, torrent.length, port
-            )
-            sock.sendto(announce.to_bytes(), tracker_address)
-
-            response = sock.recv(CONFIGURATION.udp_tracker_receive_size)  # Answer should be 98 bytes
-            announce_response: AnnounceResult = AnnounceResult.from_bytes(response)
+    async def scrape(self, torrent: TorrentFile, executor: Executor = None) -> Optional[Dict[str, int]]:
+        """
+        Ask the tracker for the number of seeders, leechers and completed
+        downloads of the torrent, named as in the HTTP scrape response
+        """
+        try:
+            client = await UDPTrackerClient.get_client()
+            response = ScrapeResult.from_bytes(await client.request(self.address, Scrape(0, [torrent.hash])))
+        except (TrackerError, OSError, struct.error) as e:
+            logging.getLogger("BitTorrent").error(f"Failed to scrape {self.url}: {e}")
+            return None
 
-            if announce_response.transaction_id != announce.transaction_id:
-                logging.getLogger("BitTorrent").error(
-                    "UDP Tracker request and response are not equal"
-                )
+        if not response.files:
+            return None
 
-            peers = Tracker.extract_compact_peers(announce_response.peers)
-            logging.getLogger("BitTorrent").info(
-                f"success in scraping {self.url} got {len(peers)} peers"
-            )
-            return peers
+        seeders, completed, leechers = response.files[0]
+        return {"complete": seeders, "downloaded": completed, "incomplete": leechers}
 
-        except socket.error:
-            logging.getLogger("BitTorrent").error(
-                f"Tracker {url_details.hostname}:{url_details.port} give no answer"
-            )
-            return []
+    def close(self):
+        try:
+            UDPTrackerClient.close_client()
+        except RuntimeError:
+            pass  # No running event loop, so no client
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+from PyBitTorrent.Configuration import CONFIGURATION
+from PyBitTorrent.Exceptions import TrackerError
+from PyBitTorrent.UDPTrackerMessage import Connection, Error, CONNECT, ERROR
+
+# Seconds a connection ID may be used after it was received (BEP 15)
+CONNECTION_ID_LIFETIME = 60
+
+
+class UDPTrackerClient(asyncio.DatagramProtocol):
+    # The client of each event loop, shared by all the UDP trackers
+    _clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, UDPTrackerClient]" = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        """
+        All the UDP trackers talk through this single socket, following BEP 15:
+        https://www.bittorrent.org/beps/bep_0015.html
+        The responses are matched to the requests by their transaction ID,
+        the connection ID of every tracker is reused for a minute, and a
+        request that got no answer is sent again after 15 * 2 ^ n seconds.
+        """
+        self.transport: asyncio.DatagramTransport = None
+        self._ready: asyncio.Future = None
+        self._transactions: Dict[int, Tuple[Tuple[str, int], asyncio.Future]] = {}
+        # Tracker address to its connection ID and the time it was received
+        self._connections: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        # Tracker host name and port to the resolved address
+        self._addresses: Dict[Tuple[str, int], Tuple[str, int]] = {}
+
+    @classmethod
+    async def get_client(cls) -> "UDPTrackerClient":
+        """
+        Return the client of the running event loop,
+        its socket is opened on the first use
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None:
+            client = cls()
+            client._ready = asyncio.ensure_future(
+                loop.create_datagram_endpoint(lambda: client, family=socket.AF_INET)
+            )
+            cls._clients[loop] = client
+
+        # Shielded, so a cancelled announce doesn't cancel the socket creation of the others
+        await asyncio.shield(client._ready)
+        return client
+
+    @classmethod
+    def close_client(cls):
+        """
+        Close the client of the running event loop, if it has one
+        """
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client:
+            client.close()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address):
+        if len(data) < 8:
+            return
+
+        action, transaction_id = struct.unpack_from(">II", data)
+        expected_address, future = self._transactions.get(transaction_id, (None, None))
+        # Only the tracker the request was sent to may answer it
+        if future is None or future.done() or address[:2] != expected_address:
+            return
+
+        future.set_result(data)
+
+    def error_received(self, exc: Exception):
+        logging.getLogger("BitTorrent").debug(f"UDP tracker socket error: {exc!r}")
+
+    def connection_lost(self, exc: Optional[Exception]):
+        for _, future in self._transactions.values():
+            if not future.done():
+                future.set_exception(TrackerError("The UDP tracker socket was closed"))
+
+    async def _resolve(self, address: Tuple[str, int]) -> Tuple[str, int]:
+        """
+        Resolve the host name of the tracker once, without blocking the loop
+        """
+        if address not in self._addresses:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(*address, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self._addresses[address] = infos[0][4][:2]
+
+        return self._addresses[address]
+
+    def _connection_id(self, address) -> Optional[int]:
+        connection_id, received = self._connections.get(address, (None, 0))
+        if time.time() - received >= CONNECTION_ID_LIFETIME:
+            return None
+
+        return connection_id
+
+    async def request(self, address: Tuple[str, int], message) -> bytes:
+        """
+        Send the message to the tracker and return its response. A connection ID
+        is requested first when there is no valid one, and every lost request
+        or response adds one to the n of the next retransmission timeout.
+        """
+        await asyncio.shield(self._ready)
+        address = await self._resolve(address)
+        attempt = 0
+        connected = False  # A new connection ID was received for this request
+        while True:
+            connection_id = self._connection_id(address)
+            if connection_id is None:
+                response = await self._send(address, Connection(), attempt)
+                if response is not None:
+                    connection = Connection.from_bytes(response[:16])
+                    self._connections[address] = (connection.connection_id, time.time())
+                    connected = True
+                else:
+                    attempt += 1
+
+                continue
+
+            message.connection_id = connection_id
+            try:
+                response = await self._send(address, message, attempt)
+            except TrackerError:
+                # The cached connection ID may be the reason, try once more with a new one
+                self._connections.pop(address, None)
+                if connected:
+                    raise
+
+                connected = True
+                continue
+
+            if response is not None:
+                return response
+
+            attempt += 1
+
+    async def _send(self, address, message, attempt) -> Optional[bytes]:
+        """
+        Send the message once, and wait for its response until the
+        retransmission timeout of the attempt. None means no answer.
+        """
+        if attempt > CONFIGURATION.udp_max_retransmits:
+            raise TrackerError(f"No answer from {address[0]}:{address[1]}")
+
+        message.transaction_id = self._new_transaction_id()
+        future = asyncio.get_running_loop().create_future()
+        self._transactions[message.transaction_id] = (address, future)
+        try:
+            self.transport.sendto(message.to_bytes(), address)
+            data = await asyncio.wait_for(future, CONFIGURATION.udp_retransmit_base * 2 ** attempt)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._transactions.pop(message.transaction_id, None)
+
+        action, = struct.unpack_from(">I", data)
+        if action == ERROR:
+            raise TrackerError(Error.from_bytes(data).message)
+
+        if action != message.action or (action == CONNECT and len(data) < 16):
+            raise TrackerError(f"Unexpected response action {action}")
+
+        return data
+
+    def _new_transaction_id(self) -> int:
+        while True:
+            transaction_id = random.getrandbits(32)
+            if transaction_id not in self._transactions:
+                return transaction_id
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        elif self._ready is not None:
+            self._ready.cancel()
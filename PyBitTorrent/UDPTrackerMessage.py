@@ -4,6 +4,12 @@ import struct
 
 from PyBitTorrent.Configuration import CONFIGURATION
 
+# The announce events, as numbered by BEP 15
+EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
+
+# The actions of the requests and responses
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+
 
 class Connection:
     def __init__(
@@ -42,7 +48,11 @@ class Announce:
         left,
         port,
         action=1,
-        transaction_id=None
+        transaction_id=None,
+        uploaded=0,
+        downloaded=0,
+        event="started",
+        num_want=-1,
     ):
         self.connection_id = connection_id
         self.transaction_id = transaction_id
@@ -51,18 +61,17 @@ class Announce:
         self.peer_id = peer_id
         self.port = port
         self.action = action
+        self.uploaded = uploaded
+        self.downloaded = downloaded
+        self.event = EVENTS[event or ""]
+        self.num_want = num_want
 
         if transaction_id is None:
             self.transaction_id = random.randint(0, 65536)
 
     def to_bytes(self):
-        downloaded = 0
-        left = 0
-        uploaded = 0
-        event = 0
         ip = 0
         key = 0
-        num_want = -1
 
         _bytes = struct.pack(
             ">QII20s20sQQQIIIiH",
@@ -71,13 +80,13 @@ class Announce:
             self.transaction_id,
             self.info_hash,
             self.peer_id,
-            downloaded,
-            left,
-            uploaded,
-            event,
+            self.downloaded,
+            self.left,
+            self.uploaded,
+            self.event,
             ip,
             key,
-            num_want,
+            self.num_want,
             self.port,
         )
 
@@ -101,3 +110,46 @@ class AnnounceResult:
             return AnnounceResult(
                 *struct.unpack(">II", payload[:8]), 0, 0, []
             )
+
+
+class Scrape:
+    def __init__(self, connection_id, info_hashes, action=2, transaction_id=None):
+        self.connection_id = connection_id
+        self.transaction_id = transaction_id
+        self.info_hashes = info_hashes
+        self.action = action
+
+        if transaction_id is None:
+            self.transaction_id = random.randint(0, 65536)
+
+    def to_bytes(self):
+        return struct.pack(">QII", self.connection_id, self.action, self.transaction_id) + b"".join(self.info_hashes)
+
+
+class ScrapeResult:
+    def __init__(self, action, transaction_id, files=None):
+        """
+        files holds for each of the scraped torrents the
+        number of seeders, completed downloads and leechers
+        """
+        self.action = action
+        self.transaction_id = transaction_id
+        self.files = files or []
+
+    @staticmethod
+    def from_bytes(payload):
+        action, transaction_id = struct.unpack(">II", payload[:8])
+        files = [struct.unpack(">III", payload[offset:offset + 12]) for offset in range(8, len(payload) - 11, 12)]
+        return ScrapeResult(action, transaction_id, files)
+
+
+class Error:
+    def __init__(self, action, transaction_id, message=""):
+        self.action = action
+        self.transaction_id = transaction_id
+        self.message = message
+
+    @staticmethod
+    def from_bytes(payload):
+        action, transaction_id = struct.unpack(">II", payload[:8])
+        return Error(action, transaction_id, bytes(payload[8:]).decode(errors="replace"))
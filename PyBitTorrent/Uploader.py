@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import random
+from typing import Dict, List
+
+from PyBitTorrent.Configuration import CONFIGURATION
+from PyBitTorrent.Exceptions import PeerDisconnected
+from PyBitTorrent.Message import Choke, Unchoke, Request, Cancel
+from PyBitTorrent.Peer import Peer
+from PyBitTorrent.PieceStore import PieceStore
+from PyBitTorrent.PiecesManager import DiskManager
+from PyBitTorrent.WriteCache import WriteCache
+
+# Longer requests are ignored, clients never ask for more than this
+MAX_REQUEST_LENGTH = 131072
+
+# Every this number of choke rounds, another random peer is unchoked optimistically
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+
+class Uploader:
+    def __init__(self, peer_manager, piece_store: PieceStore, write_cache: WriteCache, disk_manager: DiskManager,
+                 piece_size: int, upload_slots: int = CONFIGURATION.upload_slots):
+        """
+        Serve the blocks the peers request from the verified pieces, and
+        choose which peers may request. The peers that upload to us the
+        fastest get the slots (tit for tat), and one slot is rotated between
+        the others so new peers get a chance to prove themselves.
+        """
+        self.peer_manager = peer_manager
+        self.piece_store = piece_store
+        self.write_cache = write_cache
+        self.disk_manager = disk_manager
+        self.piece_size = piece_size
+        self.upload_slots = upload_slots
+        self.uploaded = 0
+        self._senders: Dict[Peer, asyncio.Task] = {}
+        self._optimistic: Peer = None
+        self._rounds = 0
+
+    def _unchoked(self) -> List[Peer]:
+        return [peer for peer in self.peer_manager.connected_peers if not peer.am_choking]
+
+    async def peer_interested(self, peer: Peer):
+        """
+        Unchoke a peer right away when there is a free slot,
+        instead of making it wait for the next choke round
+        """
+        peer.is_interested = True
+        if peer.am_choking and len(self._unchoked()) < self.upload_slots:
+            await self._set_choking(peer, False)
+
+    async def peer_not_interested(self, peer: Peer):
+        peer.is_interested = False
+        if not peer.am_choking:
+            await self._set_choking(peer, True)
+
+    def add_request(self, peer: Peer, request: Request):
+        if peer.am_choking or request.piece_length > MAX_REQUEST_LENGTH:
+            return
+
+        index, offset, length = request.index, request.begin, request.piece_length
+        if not 0 <= index < self.piece_store.number_of_pieces or not self.piece_store.completed[index]:
+            return
+
+        if offset + length > self.piece_store.get_piece_size(index):
+            return
+
+        peer.upload_requests.append((index, offset, length))
+        if peer not in self._senders:
+            self._senders[peer] = asyncio.ensure_future(self._serve(peer))
+
+    def cancel_request(self, peer: Peer, cancel: Cancel):
+        try:
+            peer.upload_requests.remove((cancel.index, cancel.begin, cancel.piece_length))
+        except ValueError:
+            pass  # Already sent
+
+    def peer_removed(self, peer: Peer):
+        peer.upload_requests.clear()
+        sender = self._senders.pop(peer, None)
+        if sender:
+            sender.cancel()
+
+    def block_sent(self, size):
+        """
+        Count the uploaded bytes only once a block was written to its peer,
+        the queued blocks of a peer that disconnects never were uploaded
+        """
+        self.uploaded += size
+
+    async def _serve(self, peer: Peer):
+        """
+        Send the requested blocks one after the other,
+        until the peer has no requests left
+        """
+        try:
+            while peer.upload_requests:
+                index, offset, length = peer.upload_requests.popleft()
+                await peer.send_piece(index, offset, self._block_sources(index, offset, length))
+        except PeerDisconnected:
+            self.peer_manager.remove_peer(peer)
+        finally:
+            if self._senders.get(peer) is asyncio.current_task():
+                del self._senders[peer]
+
+    def _block_sources(self, index, offset, length):
+        """
+        A piece still in the write cache is sent from the memory,
+        otherwise the block is sent from the files
+        """
+        offset += index * self.piece_size
+        data = self.write_cache.get(offset, length)
+        if data is not None:
+            return [data]
+
+        return self.disk_manager.sources(offset, length)
+
+    async def _set_choking(self, peer: Peer, choking: bool):
+        peer.am_choking = choking
+        if choking:
+            peer.upload_requests.clear()  # Choking discards the requests
+
+        try:
+            await peer.send_message(Choke() if choking else Unchoke())
+        except PeerDisconnected:
+            self.peer_manager.remove_peer(peer)
+
+    async def choke_round(self):
+        """
+        Unchoke the interested peers that upload to us the fastest, or that
+        we upload to the fastest once we have all the pieces, and one
+        optimistic peer. Choke all the others.
+        """
+        seeding = self.piece_store.is_complete()
+        interested = [peer for peer in self.peer_manager.connected_peers if peer.is_interested]
+        interested.sort(key=lambda peer: peer.upload_rate if seeding else peer.download_rate, reverse=True)
+        unchoke = interested[:max(self.upload_slots - 1, 0)]
+
+        others = interested[len(unchoke):]
+        if self._optimistic not in others or self._rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0:
+            self._optimistic = random.choice(others) if others else None
+        if self._optimistic:
+            unchoke.append(self._optimistic)
+
+        self._rounds += 1
+        for peer in list(self.peer_manager.connected_peers):
+            choking = peer not in unchoke
+            if choking != peer.am_choking:
+                await self._set_choking(peer, choking)
+
+    async def run(self):
+        """
+        Run the choke rounds, for as long as the client runs
+        """
+        while True:
+            await self.choke_round()
+            await asyncio.sleep(CONFIGURATION.choke_interval)
+
+    def close(self):
+        for sender in list(self._senders.values()):
+            sender.cancel()
+
+        logging.getLogger("BitTorrent").info(f"Uploaded {self.uploaded} bytes")
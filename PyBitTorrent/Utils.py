@@ -17,7 +17,7 @@ def read_peers_from_input(peers_input):
         """
         Read the peers ip and port from the peers file
         """
-        with open(peers_file_path, 'rb') as peers_file:
+        with open(peers_input, 'rb') as peers_file:
             connections = peers_file.readlines()
 
         for connection in connections:
@@ -32,7 +32,7 @@ def read_peers_from_input(peers_input):
         """
         for peer in peers_input.split(","):
             ip, port = peer.split(":")
-            peer = Peer(ip=ip, port=port)
+            peer = Peer(ip=ip, port=int(port))
             peers.append(peer)
 
     return peers
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from PyBitTorrent.Configuration import CONFIGURATION
+from PyBitTorrent.Exceptions import DiskWriteFailed
+from PyBitTorrent.PiecesManager import DiskManager
+
+
+class WriteCache:
+    def __init__(
+            self,
+            disk_manager: DiskManager,
+            piece_size: int,
+            max_size: int = CONFIGURATION.write_cache_size,
+            max_age: float = CONFIGURATION.write_cache_max_age,
+    ):
+        """
+        Write-back cache of verified pieces. The pieces are kept in
+        memory and written in the background, sorted by their index,
+        so adjacent pieces are merged to one large vectored write.
+        The cache flushes when it holds max_size bytes, when its
+        oldest piece waited max_age seconds, or on close. When a write
+        fails, its pieces stay in the cache and it stops flushing.
+        """
+        self.disk_manager = disk_manager
+        self.piece_size = piece_size
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self.pieces: Dict[int, memoryview] = {}
+        self.flushing_pieces: Dict[int, memoryview] = {}  # Being written right now
+        self.dirty_bytes = 0
+        self._oldest = 0.0
+        self._flush: asyncio.Future = None
+        self._disk_pool = ThreadPoolExecutor(1)
+        self.on_flushed = None  # Called with the indices of the pieces after they were written
+        self.on_failed = None  # Called with the error when a write failed
+        self.error: Optional[DiskWriteFailed] = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    def is_full(self) -> bool:
+        return self.dirty_bytes >= self.max_size
+
+    async def write_piece(self, piece):
+        """
+        Add the piece to the cache, while the cache is
+        full wait for the flush to make room for it. Raises
+        DiskWriteFailed when the cache can't be written anymore.
+        """
+        data = memoryview(piece.get_data())
+        while self.dirty_bytes and self.dirty_bytes + len(data) > self.max_size:
+            self.flush()
+            await self._flush
+            if self.error is not None:
+                raise self.error
+
+        if not self.pieces:
+            self._oldest = time.time()
+
+        self.pieces[piece.index] = data
+        self.dirty_bytes += len(data)
+        self.flush_if_needed()
+
+    def flush_if_needed(self):
+        if not self.pieces:
+            return
+
+        if self.is_full() or time.time() - self._oldest >= self.max_age:
+            self.flush()
+
+    def flush(self):
+        """
+        Start writing all the cached pieces in the background
+        """
+        if self.error is not None:
+            return
+
+        if self._flush is None or self._flush.done():
+            self._flush = asyncio.ensure_future(self._flush_pieces())
+
+    async def _flush_pieces(self):
+        while self.pieces:
+            self.flushing_pieces, self.pieces = self.pieces, {}
+            start = time.time()
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self._disk_pool, self._write_runs, self.flushing_pieces)
+            except OSError as e:
+                # The pieces are still dirty, they go back to the cache and are never lost
+                self.pieces.update(self.flushing_pieces)
+                self.flushing_pieces = {}
+                self.error = DiskWriteFailed(f"Failed to write {len(self.pieces)} pieces: {e}")
+                logging.getLogger("BitTorrent").error(str(self.error))
+                if self.on_failed:
+                    self.on_failed(self.error)
+                return
+
+            duration = time.time() - start
+            self.flushes += 1
+            self.flush_time += duration
+            self.max_flush_time = max(self.max_flush_time, duration)
+            self.dirty_bytes -= sum(len(data) for data in self.flushing_pieces.values())
+            written, self.flushing_pieces = self.flushing_pieces, {}
+            self._oldest = time.time()
+            if self.on_flushed:
+                self.on_flushed(list(written))
+
+    def _write_runs(self, pieces: Dict[int, memoryview]):
+        """
+        Runs in the disk thread. Merge the runs of
+        adjacent pieces and write each run at once.
+        """
+        run: List[memoryview] = []
+        run_start = None
+        for index in sorted(pieces):
+            if run and index != run_start + len(run):
+                self.disk_manager.write(run_start * self.piece_size, run)
+                run = []
+
+            if not run:
+                run_start = index
+
+            run.append(pieces[index])
+
+        if run:
+            self.disk_manager.write(run_start * self.piece_size, run)
+
+        self.disk_manager.written += len(pieces)
+
+    def get(self, offset, length) -> Optional[memoryview]:
+        """
+        Return a range of the torrent data inside a single
+        piece if the piece is in the cache, otherwise None
+        """
+        index, piece_offset = divmod(offset, self.piece_size)
+        data = self.pieces.get(index)
+        if data is None:
+            data = self.flushing_pieces.get(index)
+
+        if data is not None and piece_offset + length <= len(data):
+            self.hits += 1
+            return data[piece_offset:piece_offset + length]
+
+        self.misses += 1
+        return None
+
+    @property
+    def hit_rate(self) -> float:
+        reads = self.hits + self.misses
+        return self.hits / reads if reads else 0.0
+
+    def log_statistics(self):
+        average = self.flush_time / self.flushes if self.flushes else 0.0
+        logging.getLogger("BitTorrent").info(
+            f"Write cache: hit rate {self.hit_rate:.0%}, dirty bytes {self.dirty_bytes}, "
+            f"{self.flushes} flushes, flush latency average {average * 1000:.1f}ms "
+            f"max {self.max_flush_time * 1000:.1f}ms"
+        )
+
+    async def close(self):
+        """
+        Write everything left and stop the disk thread,
+        raises DiskWriteFailed when some pieces weren't written
+        """
+        self.flush()
+        await self._flush
+        self._disk_pool.shutdown()
+        self.log_statistics()
+        if self.error is not None:
+            raise self.error
@@ -1,105 +1,243 @@
-from io import BytesIO, SEEK_CUR
-from string import digits
-from typing import List, Dict, Union
-import functools
+from io import BytesIO
+from typing import List, Dict, Optional, Tuple, Union
 
 from PyBitTorrent.Exceptions import UnexpectedResponse
 
 END_CHAR = b'e'
 
+# The first byte of each type, as the ints indexing bytes returns
+_INT, _LIST, _DICT, _END = b'i'[0], b'l'[0], b'd'[0], b'e'[0]
+_ZERO, _NINE, _COLON = b'0'[0], b'9'[0], b':'[0]
 
-def get_int(data: BytesIO, end=END_CHAR) -> int:
+
+def _string_bounds(data: bytes, index: int) -> Tuple[int, int]:
     """
-    Read until reach the int end char
+    Return the start and end of the string whose length starts in
+    the index. The short lengths are read without creating objects.
+    The length must be digits only, and the string inside the data.
     """
-    value = ''
-    byte = data.read(1)  # we need the first number of length
+    first = data[index]
+    if not _ZERO <= first <= _NINE:
+        raise UnexpectedResponse
 
-    while byte != end:
-        if byte == end:
-            break
+    second = data[index + 1]
+    if second == _COLON:
+        start, end = index + 2, index + 2 + first - _ZERO
+    elif data[index + 2] == _COLON and _ZERO <= second <= _NINE:
+        start, end = index + 3, index + 3 + (first - _ZERO) * 10 + second - _ZERO
+    else:
+        colon = data.index(b':', index)
+        length = data[index:colon]
+        if not length.isdigit():
+            raise UnexpectedResponse
 
-        value += byte.decode()
-        byte = data.read(1)
+        start, end = colon + 1, colon + 1 + int(length)
+
+    if end > len(data):
+        raise UnexpectedResponse
 
-    return int(value)
+    return start, end
 
 
-def get_string(data: BytesIO) -> bytes:
+def _decode_string(data: bytes, index: int, decode: bool, view: memoryview):
     """
-    Read the length of the string,
-    And then read this amount of bytes
+    Take the string that starts in the index. With decode, a string that is
+    valid UTF-8 is returned as str. With view, a zero copy memoryview slice is
+    returned instead of bytes.
     """
-    data.seek(-1, SEEK_CUR)
-    length = get_int(data, b':')
-    value = data.read(length)
-    try:
-        value = value.decode()
-    except UnicodeDecodeError:
-        pass
+    start, end = _string_bounds(data, index)
+    value = view[start:end] if view is not None else data[start:end]
+    if decode:
+        try:
+            value = str(value, 'utf-8')
+        except UnicodeDecodeError:
+            pass
 
-    return value
+    return value, end
 
 
-def get_dict(data) -> Dict:
+def _decode_key(data: bytes, index: int, keys: Optional[Dict[bytes, str]]):
     """
-    Read the first key, and then
-    iterate over the all the dictionary.
+    Take the dict key that starts in the index, the decoded
+    keys are cached in keys since the same keys repeat
     """
-    key: bytes = bdecode(data)
-    dictionary = {}
-    while key:
-        if type(key) == dict :
-            for k, v in key.items() :
-                if k not in dictionary :
-                    dictionary[k] = v
-        else :
-            value = bdecode(data)
-            dictionary[key] = value
+    start, end = _string_bounds(data, index)
+    key = data[start:end]
+    if keys is None:
+        return key, end
 
-        key = bdecode(data)
+    decoded = keys.get(key)
+    if decoded is None:
+        try:
+            decoded = str(key, 'utf-8')
+        except UnicodeDecodeError:
+            decoded = key
 
-    return dictionary
+        keys[key] = decoded
 
+    return decoded, end
 
-def get_list(data):
+
+def _decode(data: bytes, index: int, keys: Optional[Dict[bytes, str]], decode_strings: bool, view: memoryview):
+    """
+    Decode the value that starts in the index of the data, return it with
+    the index of the byte after it. The strings and ints in the lists and
+    dicts are read in place, only the nested lists and dicts recurse.
     """
-    Read the first value, then
-    iterate over all the list values
+    kind = data[index]
+    if _ZERO <= kind <= _NINE:
+        return _decode_string(data, index, decode_strings, view)
+
+    if kind == _INT:
+        end = data.index(END_CHAR, index)
+        return int(data[index + 1:end]), end + 1
+
+    if kind == _LIST:
+        values = []
+        append = values.append
+        index += 1
+        kind = data[index]
+        while kind != _END:
+            if _ZERO <= kind <= _NINE:
+                value, index = _decode_string(data, index, decode_strings, view)
+            elif kind == _INT:
+                end = data.index(END_CHAR, index)
+                value, index = int(data[index + 1:end]), end + 1
+            else:
+                value, index = _decode(data, index, keys, decode_strings, view)
+
+            append(value)
+            kind = data[index]
+
+        return values, index + 1
+
+    if kind == _DICT:
+        dictionary = {}
+        index += 1
+        while data[index] != _END:
+            key, index = _decode_key(data, index, keys)
+            kind = data[index]
+            if _ZERO <= kind <= _NINE:
+                dictionary[key], index = _decode_string(data, index, decode_strings, view)
+            elif kind == _INT:
+                end = data.index(END_CHAR, index)
+                dictionary[key], index = int(data[index + 1:end]), end + 1
+            else:
+                dictionary[key], index = _decode(data, index, keys, decode_strings, view)
+
+        return dictionary, index + 1
+
+    raise UnexpectedResponse
+
+
+def _as_buffer(data) -> bytes:
+    # The parsing needs bytes.index and hashable slices, a memoryview or bytearray is copied once
+    if not isinstance(data, bytes):
+        return bytes(data)
+
+    return data
+
+
+def bdecode(
+    data: Union[bytes, bytearray, memoryview], decode_keys: bool = True,
+    decode_strings: bool = True, views: bool = False, index: int = 0,
+) -> Union[bytes, int, Dict, List]:
     """
-    values = []
-    value = bdecode(data)
-    while value:
-        values.append(value)
-        value = bdecode(data)
+    Decode the bencoded data by walking it with an index.
+    decode_keys and decode_strings decide if the dict keys and the other
+    strings that are valid UTF-8 are returned as str, otherwise all the
+    strings are bytes. With views, the strings that are not decoded are
+    memoryview slices of the data, so big strings are never copied.
+    Only the value that starts in the given index is decoded, so a value
+    inside the data is decoded without slicing it out first.
+    """
+    buffer = _as_buffer(data)
+    view = memoryview(buffer) if views else None
+    try:
+        value, end = _decode(buffer, index, {} if decode_keys else None, decode_strings, view)
+    except (IndexError, ValueError, RecursionError):
+        raise UnexpectedResponse
 
-    return values
+    # A string cut by the end of the data makes the next read fail, unless it was the last
+    if end > len(buffer):
+        raise UnexpectedResponse
 
+    return value
 
-TYPES = {
-    b'i': get_int,
-    b'd': get_dict,
-    b'l': get_list
-}
-TYPES.update({digit.encode(): get_string for digit in digits})
 
+def bspan(data: Union[bytes, bytearray], index: int = 0) -> int:
+    """
+    Return the index of the byte after the value that starts in
+    the given index, without creating any of the objects in it
+    """
+    depth = 0
+    try:
+        while True:
+            kind = data[index]
+            if kind == _LIST or kind == _DICT:
+                depth += 1
+                index += 1
+                continue
+
+            if kind == _END:
+                depth -= 1
+                index += 1
+                if depth < 0:
+                    raise UnexpectedResponse
+            elif kind == _INT:
+                index = data.index(END_CHAR, index) + 1
+            else:
+                index = _string_bounds(data, index)[1]
+
+            if depth == 0:
+                if index > len(data):
+                    raise UnexpectedResponse
+
+                return index
+    except (IndexError, ValueError):
+        raise UnexpectedResponse
+
+
+def _spans(data: bytes, index: int, keys: Optional[Dict[bytes, str]], nested: Optional[Dict]) -> Tuple[Dict, int]:
+    if data[index] != _DICT:
+        raise UnexpectedResponse
+
+    spans = {}
+    index += 1
+    while data[index] != _END:
+        key, index = _decode_key(data, index, keys)
+        if index >= len(data):
+            raise UnexpectedResponse
 
-def bdecode(data: bytes) -> Union[bytes, int, Dict, List]:
-    # For the user call
-    if isinstance(data, bytes):
-        data = BytesIO(data)
+        if nested is not None and key in nested:
+            nested[key], end = _spans(data, index, keys, None)
+        else:
+            end = bspan(data, index)
 
-    first_char = data.read(1)
-    if first_char == END_CHAR:
-        return None
+        spans[key] = (index, end)
+        index = end
 
+    return spans, index + 1
+
+
+def bdecode_spans(
+    data: Union[bytes, bytearray, memoryview], index: int = 0,
+    decode_keys: bool = True, nested: Dict[str, Dict] = None,
+) -> Dict:
+    """
+    Map each key of the dict that starts in the given index to the start and
+    end of its raw value in the data, without decoding the values. The raw
+    value can then be hashed as is, or decoded only when it is needed.
+    The keys of nested whose values are dicts are set to the spans of
+    these dicts, found in the same walk, so they are walked only once.
+    """
+    data = _as_buffer(data)
     try:
-        decoder = TYPES[first_char]
-    except:
+        spans, _ = _spans(data, index, {} if decode_keys else None, nested)
+    except (IndexError, ValueError):
         raise UnexpectedResponse
 
-    value = decoder(data)
-    return value
+    return spans
 
 
 # Encoders
@@ -136,11 +274,16 @@ def encode_list(data: List, stream: BytesIO):
 @with_end
 def encode_dict(data: Dict, stream: BytesIO):
     stream.write(b'd')
-    for key, value in data.items():
+    # The keys must be sorted as raw strings
+    for key, value in sorted(data.items(), key=lambda item: _raw_key(item[0])):
         bencode(key, stream)
         bencode(value, stream)
 
 
+def _raw_key(key: Union[bytes, str]) -> bytes:
+    return key.encode() if type(key) is str else key
+
+
 ENCODE_TYPES = {
     str: encode_buffer,
     bytes: encode_buffer,
@@ -14,12 +14,19 @@ def main():
     parser.add_argument('--output-directory', default='.', type=str, help='Path to the output directory')
     parser.add_argument('--use-progress-bar', action='store_true', default=False, help='should show progress bar')
     parser.add_argument('--max-peers', type=int, default=12, help='Max connected peers')
+    parser.add_argument('--sequential-download', action='store_true', default=False, help='download the pieces by their order instead of rarest first')
+    parser.add_argument('--seed', action='store_true', default=False, help='keep uploading to other peers after the download completed')
+    parser.add_argument('--show-torrent', action='store_true', default=False, help='print the content of the torrent file')
     args = parser.parse_args()
 
     # Create client from the BitTorrent Meta File
     torrent_client = TorrentClient(torrent=args.torrent, max_peers=args.max_peers,
-                                   use_progress_bar=args.use_progress_bar, peers_file=args.peers,
-                                   output_dir=args.output_directory)
+                                   use_progress_bar=args.use_progress_bar, peers_input=args.peers,
+                                   output_dir=args.output_directory,
+                                   sequential_download=args.sequential_download,
+                                   seed=args.seed)
+    if args.show_torrent:
+        torrent_client.torrent.print_configuration()
 
     # Start downloading the file
     torrent_client.start()
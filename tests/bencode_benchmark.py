@@ -0,0 +1,133 @@
+"""
+Benchmark of the bencode decoder, on a big metainfo file and on tracker
+responses, against the former decoder that read the data byte by byte.
+
+    python bencode_benchmark.py [pieces] [files] [path of a .torrent file]
+
+Run it from the repository root, the package reads ./config.json.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO, SEEK_CUR
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyBitTorrent.bcoder import bdecode, bdecode_spans, bencode  # noqa: E402
+from PyBitTorrent.TorrentFile import TorrentFile  # noqa: E402
+
+
+def legacy_bdecode(data):
+    """
+    The former decoder, without the merging of malformed dicts
+    """
+    if isinstance(data, bytes):
+        data = BytesIO(data)
+
+    first_char = data.read(1)
+    if first_char == b"e":
+        return None
+
+    if first_char == b"i":
+        return legacy_int(data)
+    if first_char == b"l":
+        values = []
+        value = legacy_bdecode(data)
+        while value:
+            values.append(value)
+            value = legacy_bdecode(data)
+        return values
+    if first_char == b"d":
+        dictionary = {}
+        key = legacy_bdecode(data)
+        while key:
+            dictionary[key] = legacy_bdecode(data)
+            key = legacy_bdecode(data)
+        return dictionary
+
+    data.seek(-1, SEEK_CUR)
+    value = data.read(legacy_int(data, b":"))
+    try:
+        value = value.decode()
+    except UnicodeDecodeError:
+        pass
+    return value
+
+
+def legacy_int(data, end=b"e"):
+    value = ""
+    byte = data.read(1)
+    while byte != end:
+        value += byte.decode()
+        byte = data.read(1)
+    return int(value)
+
+
+def make_metainfo(pieces, files):
+    info = {
+        "files": [{"length": 1 + index, "path": ["directory", f"file {index}"]} for index in range(files)],
+        "name": "benchmark",
+        "piece length": 262144,
+        "pieces": b"".join(hashlib.sha1(str(index).encode()).digest() for index in range(pieces)),
+    }
+    return bencode({"announce": "http://127.0.0.1/announce", "info": info})
+
+
+def make_tracker_responses():
+    compact = bencode({"interval": 1800, "peers": bytes(range(256)) * 24})
+    dictionary = bencode({
+        "interval": 1800,
+        "peers": [{"ip": f"10.0.{index // 256}.{index % 256}", "peer id": "-PB0001-%012d" % index, "port": 6881}
+                  for index in range(200)],
+    })
+    return compact, dictionary
+
+
+def measure(name, function, data, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(data)
+    elapsed = (time.perf_counter() - start) / repeat
+    if isinstance(data, (str, bytes)):
+        size = os.path.getsize(data) if isinstance(data, str) else len(data)
+    else:
+        size = len(bencode(data))
+    print(f"{name:<40} {elapsed * 1000:10.2f} ms {size / elapsed / 2 ** 20:10.1f} MB/s")
+    return elapsed
+
+
+def main():
+    pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], "rb") as torrent_file:
+            metainfo = torrent_file.read()
+    else:
+        metainfo = make_metainfo(pieces, files)
+
+    print(f"metainfo of {len(metainfo) / 2 ** 20:.1f} MB")
+    legacy = measure("legacy bdecode", legacy_bdecode, metainfo, 1)
+    new = measure("bdecode", bdecode, metainfo, 5)
+    measure("bdecode, keys only", lambda data: bdecode(data, decode_strings=False), metainfo, 5)
+    measure("bdecode, keys only, views", lambda data: bdecode(data, decode_strings=False, views=True), metainfo, 5)
+    measure("bdecode_spans (info hash only)", lambda data: bdecode_spans(data)["info"], metainfo, 20)
+    print(f"speedup {legacy / new:.1f}x")
+
+    with tempfile.NamedTemporaryFile(suffix=".torrent", delete=False) as torrent_file:
+        torrent_file.write(metainfo)
+    try:
+        measure("TorrentFile", TorrentFile, torrent_file.name, 5)
+    finally:
+        os.remove(torrent_file.name)
+
+    for name, response in zip(("compact", "dict"), make_tracker_responses()):
+        print(f"\n{name} tracker response of {len(response)} bytes")
+        legacy = measure("legacy bdecode", legacy_bdecode, response, 200)
+        new = measure("bdecode, keys only", lambda data: bdecode(data, decode_strings=False), response, 2000)
+        print(f"speedup {legacy / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark of parsing and encoding the peer wire messages, one
+message of every type, in messages per second.
+
+    python message_codec_benchmark.py [repeat]
+
+Run it from the repository root, the package reads ./config.json.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyBitTorrent.Message import (  # noqa: E402
+    BitField,
+    Cancel,
+    Choke,
+    HaveMessage,
+    Interested,
+    KeepAlive,
+    NotInterested,
+    PieceMessage,
+    Port,
+    Request,
+    Unchoke,
+)
+from PyBitTorrent.MessageFactory import MessageFactory  # noqa: E402
+
+
+def make_messages():
+    return [
+        KeepAlive(),
+        Choke(),
+        Unchoke(),
+        Interested(),
+        NotInterested(),
+        HaveMessage(1234),
+        BitField(b"\xff" * 128),
+        Request(1234, 16384, 16384),
+        Cancel(1234, 16384, 16384),
+        PieceMessage(1234, 16384, bytearray(16384)),
+        Port(6881),
+    ]
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    buffer = bytearray(32768)
+    print(f"{'messages per second':<20} {'parse':>12} {'to_bytes':>12} {'pack_into':>12}")
+    for message in make_messages():
+        # The payload as the peer receiver gives it, without the length prefix
+        payload = bytearray(message.to_bytes()[4:])
+        rates = [
+            measure(lambda: MessageFactory.create_message(payload), repeat),
+            measure(message.to_bytes, repeat),
+            measure(lambda: message.pack_into(buffer, 0), repeat),
+        ]
+        print(f"{type(message).__name__:<20}" + "".join(f" {rate:12,.0f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark of receiving peer messages, a stream of piece messages with
+have messages between them sent over a socket pair, against the former
+receiver that made a recv for the length, the header and the payload
+of every message.
+
+    python peer_receive_benchmark.py [blocks] [block size]
+
+Run it from the repository root, the package reads ./config.json.
+"""
+import asyncio
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyBitTorrent.Message import MessageCode, PieceMessage  # noqa: E402
+from PyBitTorrent.MessageFactory import MessageFactory  # noqa: E402
+from PyBitTorrent.Peer import Peer, PIECE_HEADER_SIZE  # noqa: E402
+
+
+class LegacyPeer(Peer):
+    """
+    The former receiver, the length and the header of each message are
+    received by themselves, and the block straight into its own memory
+    """
+    async def _receive(self, size):
+        data = bytearray(size)
+        await self._receive_into(memoryview(data))
+        return data
+
+    async def receive_message(self):
+        header = await self._receive(4)
+        length, = struct.unpack(">I", header)
+        if length < PIECE_HEADER_SIZE:
+            return MessageFactory.create_message(await self._receive(length))
+
+        header = await self._receive(PIECE_HEADER_SIZE)
+        if header[0] != MessageCode.PIECE:
+            data = header + await self._receive(length - PIECE_HEADER_SIZE)
+            return MessageFactory.create_message(data)
+
+        index, offset = struct.unpack_from(">II", header, 1)
+        target = memoryview(bytearray(length - PIECE_HEADER_SIZE))
+        await self._receive_into(target)
+        return PieceMessage(index, offset, target)
+
+    async def receive_messages(self):
+        return [await self.receive_message()]
+
+
+def make_stream(blocks, block_size):
+    block = os.urandom(block_size)
+    messages = []
+    for number in range(blocks):
+        messages.append(struct.pack(">IBII", PIECE_HEADER_SIZE + block_size, MessageCode.PIECE, number, 0))
+        messages.append(block)
+        messages.append(struct.pack(">IBI", 5, MessageCode.HAVE, number))
+
+    return b"".join(messages)
+
+
+def send(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+async def receive(peer_class, data, blocks):
+    sender_socket, receiver_socket = socket.socketpair()
+    peer = peer_class("127.0.0.1", 0, sock=receiver_socket)
+    peer.connected = True
+
+    loop = asyncio.get_running_loop()
+    receive_into = loop.sock_recv_into
+    calls = 0
+
+    def counting_receive_into(sock, buffer):
+        nonlocal calls
+        calls += 1
+        return receive_into(sock, buffer)
+
+    loop.sock_recv_into = counting_receive_into
+    sender = threading.Thread(target=send, args=(sender_socket, data))
+    start = time.perf_counter()
+    sender.start()
+    received = 0
+    while received < 2 * blocks:
+        received += len(await peer.receive_messages())
+
+    elapsed = time.perf_counter() - start
+    sender.join()
+    sender_socket.close()
+    peer.close()
+    del loop.sock_recv_into
+    return elapsed, calls
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16384
+    data = make_stream(blocks, block_size)
+    print(f"{blocks} blocks of {block_size} bytes, {len(data) / 2 ** 20:.0f} MB")
+
+    results = {}
+    for name, peer_class in (("legacy receive_message", LegacyPeer), ("buffered receive_messages", Peer)):
+        elapsed, calls = asyncio.run(receive(peer_class, data, blocks))
+        results[name] = elapsed
+        print(f"{name:<30} {elapsed * 1000:10.1f} ms {len(data) / elapsed / 2 ** 20:10.1f} MB/s "
+              f"{calls:8} recv calls {calls / (2 * blocks):6.2f} per message")
+
+    legacy, buffered = results.values()
+    print(f"speedup {legacy / buffered:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
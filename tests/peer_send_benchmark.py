@@ -0,0 +1,142 @@
+"""
+Benchmark of sending peer messages over a socket pair: pipelined
+requests, and blocks to a fast and to a slow reader, against the former
+sender that made a sendall for every message. Also checks that the
+reader gets every byte in order, and that a control message queued
+behind many blocks is sent before them.
+
+    python peer_send_benchmark.py [requests] [blocks]
+
+Run it from the repository root, the package reads ./config.json.
+"""
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyBitTorrent.Message import Choke, PieceMessage, Request  # noqa: E402
+from PyBitTorrent.Peer import Peer  # noqa: E402
+
+BLOCK_SIZE = 16384
+
+
+class CountingSocket(socket.socket):
+    """
+    A socket that counts its send syscalls
+    """
+    calls = 0
+
+    def send(self, *args):
+        CountingSocket.calls += 1
+        return super().send(*args)
+
+    def sendmsg(self, *args):
+        CountingSocket.calls += 1
+        return super().sendmsg(*args)
+
+
+class LegacyPeer(Peer):
+    """
+    The former sender, every message is sent by itself
+    """
+    async def send_message(self, message):
+        await asyncio.get_running_loop().sock_sendall(self.socket, message.to_bytes())
+
+    async def send_piece(self, index, offset, parts):
+        loop = asyncio.get_running_loop()
+        length = sum(len(part) for part in parts)
+        await loop.sock_sendall(self.socket, PieceMessage.header(index, offset, length))
+        for part in parts:
+            await loop.sock_sendall(self.socket, part)
+
+    async def flush(self):
+        pass
+
+
+def read_all(sock, size, chunk, delay, received):
+    while len(received) < size:
+        data = sock.recv(chunk)
+        if not data:
+            break
+        received += data
+        if delay:
+            time.sleep(delay)
+
+
+async def send(peer_class, messages, blocks, chunk, delay):
+    sender_socket, receiver_socket = socket.socketpair()
+    sender_socket = CountingSocket(fileno=sender_socket.detach())
+    sender_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+    peer = peer_class("127.0.0.1", 0, sock=sender_socket)
+    block = memoryview(os.urandom(BLOCK_SIZE))
+    expected = b"".join(message.to_bytes() for message in messages)
+    expected += b"".join(PieceMessage.header(index, 0, BLOCK_SIZE) + block for index in range(blocks))
+
+    received = bytearray()
+    reader = threading.Thread(target=read_all, args=(receiver_socket, len(expected), chunk, delay, received))
+    reader.start()
+    CountingSocket.calls = 0
+    start = time.perf_counter()
+    for message in messages:
+        await peer.send_message(message)
+    for index in range(blocks):
+        await peer.send_piece(index, 0, [block])
+    await peer.flush()
+    elapsed = time.perf_counter() - start
+
+    await asyncio.get_running_loop().run_in_executor(None, reader.join)
+    assert received == expected, "The received data is different"
+    calls = CountingSocket.calls
+    peer.close()
+    receiver_socket.close()
+    return elapsed, calls
+
+
+async def control_first():
+    """
+    Queue many blocks, then a choke, and find where the choke arrived
+    """
+    sender_socket, receiver_socket = socket.socketpair()
+    peer = Peer("127.0.0.1", 0, sock=sender_socket)
+    block = memoryview(bytes(BLOCK_SIZE))
+    for index in range(32):
+        await peer.send_piece(index, 0, [block])
+    await peer.send_message(Choke())
+
+    received = bytearray()
+    reader = threading.Thread(target=read_all, args=(receiver_socket, 32 * (BLOCK_SIZE + 13) + 5, 65536, 0, received))
+    reader.start()
+    await peer.flush()
+    await asyncio.get_running_loop().run_in_executor(None, reader.join)
+    peer.close()
+    receiver_socket.close()
+    return received.find(Choke().to_bytes())
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    cases = (
+        ("requests", [Request(index // 16, index % 16 * BLOCK_SIZE, BLOCK_SIZE) for index in range(requests)], 0, 0),
+        ("blocks", [], blocks, 0),
+        ("blocks to a slow reader", [], blocks, 0.0001),
+    )
+    for name, messages, blocks_to_send, delay in cases:
+        print(f"\n{name}")
+        results = []
+        for peer_class in (LegacyPeer, Peer):
+            elapsed, calls = asyncio.run(send(peer_class, messages, blocks_to_send, 65536, delay))
+            results.append(elapsed)
+            print(f"{'legacy' if peer_class is LegacyPeer else 'queued':<20} {elapsed * 1000:10.1f} ms {calls:8} send calls")
+        print(f"speedup {results[0] / results[1]:.1f}x")
+
+    position = asyncio.run(control_first())
+    print(f"\na choke queued after 32 blocks arrived at byte {position}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import pytest
+
+from PyBitTorrent.bcoder import bdecode, bdecode_spans, bencode, bspan
+from PyBitTorrent.Exceptions import UnexpectedResponse
+
+
+def test_round_trip():
+    data = {"announce": "http://tracker/announce", "info": {"length": 42, "pieces": b"\xff" * 20}, "list": [1, -2, "a"]}
+    assert bdecode(bencode(data)) == data
+
+
+def test_keys_sorted_as_raw_strings():
+    assert bencode({"b": 1, "a": 2, b"Z": 3}) == b"d1:Zi3e1:ai2e1:bi1ee"
+
+
+def test_undecodable_strings_stay_bytes():
+    assert bdecode(bencode({"hash": b"\xff\xfe"})) == {"hash": b"\xff\xfe"}
+    assert bdecode(b"d1:a1:be", decode_strings=False) == {"a": b"b"}
+
+
+def test_views():
+    data = bencode({"peers": b"123456"})
+    peers = bdecode(data, decode_strings=False, views=True)["peers"]
+    assert isinstance(peers, memoryview) and peers == b"123456"
+
+
+def test_decode_from_index():
+    data = bencode({"files": [{"length": 1}, {"length": 2}], "name": "x"})
+    start, end = bdecode_spans(data)["files"]
+    assert bspan(data, start) == end
+    assert bdecode(data, index=start) == [{"length": 1}, {"length": 2}]
+
+
+def test_nested_spans():
+    data = bencode({"announce": "a", "info": {"length": 1, "name": "x"}})
+    nested = {"info": None}
+    spans = bdecode_spans(data, nested=nested)
+    start, end = spans["info"]
+    assert bdecode(data[start:end]) == {"length": 1, "name": "x"}
+    assert nested["info"] == bdecode_spans(data, start)
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"x", b"i12", b"ie", b"i-e", b"i1.5e", b"5:abc", b"-1:a", b"l", b"l1:a", b"d3:keye", b"d1:ai1e", b"di1ei2ee",
+])
+def test_malformed(data):
+    with pytest.raises(UnexpectedResponse):
+        bdecode(data)
+
+
+@pytest.mark.parametrize("data", [b"", b"i1e", b"l", b"d1:ai1e"])
+def test_malformed_spans(data):
+    with pytest.raises(UnexpectedResponse):
+        bdecode_spans(data)
@@ -0,0 +1,80 @@
+import struct
+
+import pytest
+
+from PyBitTorrent.Exceptions import PeerHandshakeFailed
+from PyBitTorrent.Message import (
+    BitField, Cancel, Choke, Handshake, HaveMessage, Interested, KeepAlive, NotInterested, PieceMessage, Port,
+    Request, Unchoke, UnknownMessage,
+)
+from PyBitTorrent.MessageFactory import MessageFactory
+
+
+def parse(data: bytes):
+    # The peer strips the length prefix before creating the message
+    length, = struct.unpack_from(">I", data)
+    assert len(data) == 4 + length
+    return MessageFactory.create_message(data[4:])
+
+
+@pytest.mark.parametrize("message, fields", [
+    (Request(1, 16384, 16384), ("index", "begin", "piece_length")),
+    (Cancel(2, 0, 100), ("index", "begin", "piece_length")),
+    (HaveMessage(7), ("index",)),
+    (Port(6881), ("port",)),
+])
+def test_round_trip(message, fields):
+    parsed = parse(message.to_bytes())
+    assert type(parsed) is type(message)
+    for field in fields:
+        assert getattr(parsed, field) == getattr(message, field)
+
+
+@pytest.mark.parametrize("message", [Choke(), Unchoke(), Interested(), NotInterested()])
+def test_stateless_round_trip(message):
+    assert type(parse(message.to_bytes())) is type(message)
+
+
+@pytest.mark.parametrize("message", [
+    Choke(), Request(1, 2, 3), Cancel(4, 5, 6), HaveMessage(7), Port(8), BitField(b"\xf0"),
+])
+def test_pack_into(message):
+    buffer = bytearray(64)
+    size = message.pack_into(buffer, 3)
+    assert buffer[3:3 + size] == message.to_bytes()
+
+
+def test_keep_alive():
+    assert type(MessageFactory.create_message(b"")) is KeepAlive
+
+
+def test_piece_round_trip():
+    parsed = parse(PieceMessage(3, 32, b"block data").to_bytes())
+    assert (parsed.index, parsed.offset, bytes(parsed.data)) == (3, 32, b"block data")
+
+
+def test_bitfield_round_trip():
+    parsed = parse(BitField(b"\xa5\x80").to_bytes())
+    assert parsed.bitfield.tobytes() == b"\xa5\x80"
+
+
+def test_handshake_round_trip():
+    handshake = Handshake(b"-PB0001-123456789012", b"\x01" * 20)
+    parsed = MessageFactory.create_handshake_message(handshake.to_bytes())
+    assert parsed.peer_id == handshake.peer_id and parsed == handshake
+
+
+def test_unknown_message():
+    parsed = MessageFactory.create_message(b"\x14extension")
+    assert type(parsed) is UnknownMessage and parsed.id == 20
+
+
+def test_malformed_handshake():
+    with pytest.raises(PeerHandshakeFailed):
+        MessageFactory.create_handshake_message(Handshake(b"x" * 20, b"y" * 20).to_bytes()[:-1])
+
+
+@pytest.mark.parametrize("payload", [b"\x06\x00\x00\x00\x01", b"\x04\x00", b"\x09\x1a", b"\x07\x00\x00"])
+def test_malformed_payload(payload):
+    with pytest.raises(struct.error):
+        MessageFactory.create_message(payload)
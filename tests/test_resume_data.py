@@ -0,0 +1,87 @@
+import hashlib
+
+import pytest
+
+from PyBitTorrent.bcoder import bdecode, bencode
+from PyBitTorrent.PiecesManager import DiskManager
+from PyBitTorrent.ResumeData import ResumeData
+from PyBitTorrent.TorrentFile import TorrentFile
+
+PIECE_SIZE = 32768
+DATA = bytes(range(256)) * 320  # 2.5 pieces
+
+
+@pytest.fixture
+def torrent(tmp_path):
+    pieces = b"".join(hashlib.sha1(DATA[start:start + PIECE_SIZE]).digest() for start in range(0, len(DATA), PIECE_SIZE))
+    info = {"length": len(DATA), "name": "data", "piece length": PIECE_SIZE, "pieces": pieces}
+    path = tmp_path / "data.torrent"
+    path.write_bytes(bencode({"announce": "http://127.0.0.1/announce", "info": info}))
+    return TorrentFile(str(path))
+
+
+def open_resume_data(output, torrent):
+    disk_manager = DiskManager(str(output), torrent, False)
+    return ResumeData(str(output), torrent, disk_manager), disk_manager
+
+
+def test_round_trip(tmp_path, torrent):
+    output = tmp_path / "output"
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    resume_data.pieces_written([0, 2])
+    resume_data.save({1: b"\x01\x00"})
+    disk_manager.close()
+
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    resume = resume_data.load()
+    disk_manager.close()
+    assert resume["pieces"] == b"\x01\x00\x01"
+    assert resume["partial"] == {1: b"\x01\x00"}
+    assert resume_data.written == bytearray(b"\x01\x00\x01")
+
+
+def test_changed_file(tmp_path, torrent):
+    output = tmp_path / "output"
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    resume_data.save()
+    disk_manager.close()
+    with open(output / "data", "ab") as data_file:
+        data_file.write(b"more")
+
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    assert resume_data.load() is None
+    disk_manager.close()
+
+
+@pytest.mark.parametrize("content", [
+    b"",
+    b"not bencode",
+    b"d4:infoi1ee",
+    bencode({"info hash": "0" * 40, "pieces": b"\x00" * 3, "files": []}),
+    bencode([1, 2, 3]),
+])
+def test_malformed(tmp_path, torrent, content):
+    output = tmp_path / "output"
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    with open(resume_data.path, "wb") as resume_file:
+        resume_file.write(content)
+
+    assert resume_data.load() is None
+    disk_manager.close()
+
+
+def test_wrong_number_of_pieces(tmp_path, torrent):
+    output = tmp_path / "output"
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    resume_data.save()
+    disk_manager.close()
+
+    resume_data, disk_manager = open_resume_data(output, torrent)
+    with open(resume_data.path, "rb") as resume_file:
+        resume = bdecode(resume_file.read())
+    resume["pieces"] = b"\x01" * 2
+    with open(resume_data.path, "wb") as resume_file:
+        resume_file.write(bencode(resume))
+
+    assert resume_data.load() is None
+    disk_manager.close()
@@ -0,0 +1,98 @@
+"""
+A local UDP tracker (BEP 15) to test the UDP tracker client against.
+It answers connect, announce and scrape requests, sends an error for
+unknown connection IDs, and can drop requests to test retransmission.
+
+    python udp_tracker_test_server.py 6969 --peers 127.0.0.1:7000,127.0.0.1:7001 --drop 2
+
+Set udp_retransmit_base in config.json to a fraction of a second,
+so the dropped requests are sent again quickly.
+"""
+import argparse
+import random
+import socket
+import struct
+import time
+
+PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+CONNECTION_ID_LIFETIME = 120  # The server accepts IDs for two minutes (BEP 15)
+
+
+def error(transaction_id, message):
+    return struct.pack(">II", ERROR, transaction_id) + message.encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local UDP tracker for tests")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--peers", default="", help="peers to return, ip:port separated by commas")
+    parser.add_argument("--interval", type=int, default=60, help="announce interval to return")
+    parser.add_argument("--drop", type=int, default=0, help="number of requests to ignore first")
+    args = parser.parse_args()
+
+    compact_peers = b""
+    for peer in filter(None, args.peers.split(",")):
+        ip, port = peer.split(":")
+        compact_peers += socket.inet_aton(ip) + struct.pack(">H", int(port))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", args.port))
+    print(f"Listening on 127.0.0.1:{args.port}")
+
+    connections = {}  # connection ID -> time it was given
+    swarms = {}  # info hash -> {peer id: left}
+    completed = {}  # info hash -> completed downloads
+    to_drop = args.drop
+    while True:
+        data, address = sock.recvfrom(65536)
+        if len(data) < 16:
+            continue
+
+        connection_id, action, transaction_id = struct.unpack(">QII", data[:16])
+        if to_drop:
+            to_drop -= 1
+            print(f"Dropped action {action} from {address}")
+            continue
+
+        if action == CONNECT:
+            if connection_id != PROTOCOL_ID:
+                continue
+
+            new_id = random.getrandbits(64)
+            connections[new_id] = time.time()
+            response = struct.pack(">IIQ", CONNECT, transaction_id, new_id)
+        elif time.time() - connections.get(connection_id, 0) > CONNECTION_ID_LIFETIME:
+            response = error(transaction_id, "unknown connection id")
+        elif action == ANNOUNCE and len(data) >= 98:
+            info_hash, peer_id = data[16:36], data[36:56]
+            left, _, event = struct.unpack(">QQI", data[64:84])
+            swarm = swarms.setdefault(info_hash, {})
+            if event == 3:
+                swarm.pop(peer_id, None)
+            else:
+                swarm[peer_id] = left
+            if event == 1:
+                completed[info_hash] = completed.get(info_hash, 0) + 1
+
+            seeders = sum(1 for left in swarm.values() if left == 0)
+            response = struct.pack(
+                ">IIIII", ANNOUNCE, transaction_id, args.interval, len(swarm) - seeders, seeders
+            ) + compact_peers
+        elif action == SCRAPE:
+            response = struct.pack(">II", SCRAPE, transaction_id)
+            for offset in range(16, len(data) - 19, 20):
+                swarm = swarms.get(data[offset:offset + 20], {})
+                seeders = sum(1 for left in swarm.values() if left == 0)
+                response += struct.pack(
+                    ">III", seeders, completed.get(data[offset:offset + 20], 0), len(swarm) - seeders
+                )
+        else:
+            response = error(transaction_id, "invalid request")
+
+        print(f"Action {action} from {address}")
+        sock.sendto(response, address)
+
+
+if __name__ == "__main__":
+    main()